@@ -0,0 +1,207 @@
+"""Asyncio client for the Bugzilla XML-RPC interface.
+
+Calls are marshalled and unmarshalled with xmlrpc.client and fail with
+the same BugzError messages as Settings.call_bz, but the HTTP requests
+are made over asyncio streams so that many calls can be in flight on
+one event loop.  Connections are kept alive and reused, and at most
+max_connections requests run at the same time.
+
+The synchronous commands use run_coroutine() to drive a coroutine to
+completion.
+"""
+
+import asyncio
+import base64
+import ssl
+import time
+import urllib.parse
+import xml.parsers.expat
+import xmlrpc.client
+
+from bugz import __version__
+from bugz.exceptions import BugzError
+from bugz.log import log_debug
+from bugz.metrics import CALL_DURATION, CALL_ERRORS, CALLS, RETRIES
+from bugz.metrics import REQUEST_BYTES, RESPONSE_BYTES
+from bugz.transport import response_too_large, unmarshal
+
+
+class AsyncBugzilla:
+    def __init__(self, settings, max_connections=4,
+                 unmarshaller=xmlrpc.client.Unmarshaller):
+        self.settings = settings
+        self.max_connections = max_connections
+        self.unmarshaller = unmarshaller
+        url = urllib.parse.urlsplit(settings.base)
+        self.host = url.hostname
+        netloc = url.netloc.split('@')[-1]
+        self.url = '%s://%s%s' % (url.scheme, netloc, url.path)
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        if url.scheme == 'https':
+            self.port = url.port or 443
+            self.ssl = settings.context or ssl.create_default_context()
+        else:
+            self.port = url.port or 80
+            self.ssl = None
+        self.headers = [
+            ('Host', netloc),
+            ('User-Agent', 'pybugz/%s' % __version__),
+            ('Content-Type', 'text/xml'),
+        ]
+        if url.username is not None:
+            credentials = '%s:%s' % (urllib.parse.unquote(url.username),
+                                     urllib.parse.unquote(url.password or ''))
+            credentials = base64.b64encode(credentials.encode()).decode()
+            self.headers.append(('Authorization', 'Basic %s' % credentials))
+        self.idle = []
+        self.semaphore = None
+
+    async def call(self, method, params):
+        """Call method, e.g. 'Bug.get', with a dictionary of parameters."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        params = dict(params)
+        self.settings.add_auth(params)
+        body = xmlrpc.client.dumps((params,), method).encode('utf-8')
+        CALLS.inc(method=method)
+        try:
+            async with self.semaphore:
+                start = time.monotonic()
+                try:
+                    data = await self.request(body)
+                finally:
+                    CALL_DURATION.observe(time.monotonic() - start,
+                                          method=method)
+            return unmarshal(data, self.unmarshaller)[0]
+        except xmlrpc.client.Fault as fault:
+            CALL_ERRORS.inc(method=method)
+            raise BugzError('Bugzilla error: {0}'.format(fault.faultString))
+        except (xmlrpc.client.ProtocolError, OSError,
+                asyncio.IncompleteReadError,
+                xml.parsers.expat.ExpatError) as error:
+            CALL_ERRORS.inc(method=method)
+            raise BugzError(error)
+        except BugzError:
+            CALL_ERRORS.inc(method=method)
+            raise
+
+    async def request(self, body):
+        # A kept alive connection may have been closed by the server
+        # meanwhile, so a failure on one is retried on a new connection.
+        while self.idle:
+            reader, writer = self.idle.pop()
+            try:
+                return await self.exchange(reader, writer, body)
+            except (OSError, asyncio.IncompleteReadError) as error:
+                log_debug('retrying on a new connection: %s' % error, 2)
+                RETRIES.inc(reason='connection')
+                writer.close()
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl,
+            server_hostname=self.host if self.ssl else None)
+        try:
+            return await self.exchange(reader, writer, body)
+        except BaseException:
+            writer.close()
+            raise
+
+    async def exchange(self, reader, writer, body):
+        lines = ['POST %s HTTP/1.1' % self.path]
+        lines += ['%s: %s' % header for header in self.headers]
+        lines += ['Content-Length: %d' % len(body), '', '']
+        writer.write('\r\n'.join(lines).encode('latin-1') + body)
+        REQUEST_BYTES.inc(len(body))
+        await writer.drain()
+
+        status = await reader.readline()
+        if not status:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, code, reason = (status.decode('latin-1').rstrip('\r\n') +
+                                 '  ').split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+        max_size = self.settings.max_response_size
+
+        def check_size(size):
+            if max_size and size > max_size:
+                writer.close()
+                raise response_too_large(max_size)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            total = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in [b'\r\n', b'']:
+                        pass
+                    break
+                total += size
+                check_size(total)
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            check_size(int(headers['content-length']))
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            chunks = []
+            total = 0
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                total += len(chunk)
+                check_size(total)
+                chunks.append(chunk)
+            data = b''.join(chunks)
+            keep_alive = False
+
+        RESPONSE_BYTES.inc(len(data))
+        if keep_alive:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+        if code != '200':
+            raise xmlrpc.client.ProtocolError(self.url, int(code),
+                                              reason.strip(), headers)
+        return data
+
+    async def call_many(self, calls):
+        """Run a list of (method, params) calls concurrently.
+
+        Returns the results in the order of the calls.  If calls fail,
+        the others still run to completion and then the first error is
+        raised.
+        """
+        results = await asyncio.gather(*[self.call(method, params)
+                                         for method, params in calls],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine on a new event loop and return its result."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -0,0 +1,152 @@
+"""Portable archives of bugs made by bugz export.
+
+An archive is a directory holding:
+
+manifest.json
+    the connection and search it was made from, the ids of all the bugs
+    to export and the shards written so far.
+bugs-NNNNN.jsonl.gz
+    gzip compressed shards with one JSON object per line and bug, with
+    the keys 'bug', 'comments', 'history' and 'attachments'.  The
+    attachments are listed without their data, which is referred to by
+    the sha256 key.
+attachments/XX/SHA256
+    the attachment data, stored once per distinct content.
+
+Shards and attachments are written to temporary files and renamed, and
+a shard is only listed in the manifest once it is complete, so an
+interrupted export can be resumed by running it again.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from bugz.cache import json_default
+from bugz.exceptions import BugzError
+
+ARCHIVE_VERSION = 1
+
+
+def write_file(path, data):
+    fd, name = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(name, path)
+
+
+class ArchiveWriter:
+    """Write an archive, or continue writing an unfinished one."""
+
+    def __init__(self, path, connection, base, params):
+        self.path = path
+        os.makedirs(os.path.join(path, 'attachments'), exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest['base'] != base or \
+                    self.manifest['params'] != params:
+                raise BugzError('%s holds an export of another search' %
+                                path)
+        else:
+            self.manifest = {
+                'version': ARCHIVE_VERSION,
+                'connection': connection,
+                'base': base,
+                'params': params,
+                'ids': None,
+                'shards': [],
+                'complete': False,
+            }
+
+    def save_manifest(self):
+        data = json.dumps(self.manifest, indent=1, sort_keys=True)
+        write_file(os.path.join(self.path, 'manifest.json'), data.encode())
+
+    def done_ids(self):
+        """Return the ids of the bugs already written."""
+        ids = set()
+        for shard in self.manifest['shards']:
+            ids.update(shard['ids'])
+        return ids
+
+    def set_ids(self, ids):
+        self.manifest['ids'] = ids
+        self.save_manifest()
+
+    def add_attachment(self, data):
+        """Store attachment data unless it is already there, and return
+        its sha256.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        directory = os.path.join(self.path, 'attachments', digest[:2])
+        path = os.path.join(directory, digest)
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            write_file(path, data)
+        return digest
+
+    def add_shard(self, records):
+        """Write the records of some bugs as a new shard."""
+        name = 'bugs-%05d.jsonl.gz' % len(self.manifest['shards'])
+        lines = [json.dumps(record, default=json_default, sort_keys=True)
+                 for record in records]
+        data = gzip.compress(('\n'.join(lines) + '\n').encode())
+        write_file(os.path.join(self.path, name), data)
+        self.manifest['shards'].append({
+            'name': name,
+            'ids': [record['bug']['id'] for record in records],
+        })
+        self.save_manifest()
+
+    def finish(self):
+        self.manifest['complete'] = True
+        self.save_manifest()
+
+
+class ArchiveReader:
+    """Read an archive written by bugz export.
+
+    Iterating over it yields the records of the bugs, one shard at a
+    time, so archives larger than memory can be scanned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError) as error:
+            raise BugzError('%s is not a bugz archive: %s' % (path, error))
+        if self.manifest.get('version') != ARCHIVE_VERSION:
+            raise BugzError('%s has an unknown archive version' % path)
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    def __len__(self):
+        return sum(len(shard['ids']) for shard in self.manifest['shards'])
+
+    def __iter__(self):
+        for shard in self.manifest['shards']:
+            with gzip.open(os.path.join(self.path, shard['name']), 'rt') as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def bugs(self):
+        """Yield the bugs, without their comments, history and
+        attachments.
+        """
+        for record in self:
+            yield record['bug']
+
+    def attachment_data(self, attachment):
+        """Return the data of an attachment listed in a record."""
+        digest = attachment['sha256']
+        path = os.path.join(self.path, 'attachments', digest[:2], digest)
+        with open(path, 'rb') as f:
+            return f.read()
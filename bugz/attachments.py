@@ -0,0 +1,112 @@
+"""Local cache of downloaded attachments.
+
+Attachments never change once uploaded, so they are cached for good
+and only removed to keep the cache below attachment_cache_size
+megabytes.  The data is stored once per sha256 in
+$XDG_CACHE_HOME/pybugz/attachments/data, shared by all connections, and
+the attachments of each connection are mapped to it by their id in
+attachments/ids.  Both count towards the size of the cache.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from bugz.cache import cache_dir, load_json, safe_name, save_json
+
+BLOCK_SIZE = 65536
+
+
+def info_path(settings, attachid):
+    return os.path.join(cache_dir('attachments', 'ids',
+                                  safe_name(settings.connection)),
+                        '%s.json' % attachid)
+
+
+def data_path(digest):
+    return os.path.join(cache_dir('attachments', 'data'), digest)
+
+
+def open_attachment(settings, attachid):
+    """Return the cached info of an attachment and its data opened for
+    reading in binary mode, or None.
+    """
+    if not settings.attachment_cache_size:
+        return None
+    info = load_json(info_path(settings, attachid))
+    if info is None:
+        return None
+    try:
+        fd = open(data_path(info['sha256']), 'rb')
+        os.utime(data_path(info['sha256']))
+        os.utime(info_path(settings, attachid))
+    except OSError:
+        return None
+    return info, fd
+
+
+def cached_digest(settings, attachid):
+    """Return the sha256 of a cached attachment, or None."""
+    info = load_json(info_path(settings, attachid))
+    if info is None:
+        return None
+    return info['sha256']
+
+
+def save_attachment(settings, attachid, info, fd):
+    """Cache an attachment, given its info without the data and its data
+    as a binary file, and return the sha256 of the data.
+
+    The data is copied a block at a time, and fd is left at its end.
+    """
+    sha256 = hashlib.sha256()
+    cache = None
+    if settings.attachment_cache_size:
+        directory = cache_dir('attachments', 'data')
+        tmp, name = tempfile.mkstemp(dir=directory)
+        cache = os.fdopen(tmp, 'wb')
+    try:
+        while True:
+            block = fd.read(BLOCK_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+            if cache is not None:
+                cache.write(block)
+    finally:
+        if cache is not None:
+            cache.close()
+    digest = sha256.hexdigest()
+    if cache is None:
+        return digest
+
+    os.replace(name, data_path(digest))
+    save_json(info_path(settings, attachid), dict(info, sha256=digest))
+    evict(settings.attachment_cache_size * 1024 * 1024)
+    return digest
+
+
+def evict(max_size):
+    """Remove the least recently used data and info files until the
+    cache holds at most max_size bytes.
+    """
+    entries = []
+    total = 0
+    for directory, _, names in os.walk(cache_dir('attachments')):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,90 @@
+"""Locations of the files pybugz keeps between runs.
+
+Everything is stored below $XDG_CACHE_HOME/pybugz (~/.cache/pybugz by
+default) and can be removed at any time.
+"""
+
+import json
+import os
+import re
+import tempfile
+import time
+
+
+def cache_dir(*parts):
+    """Return the cache directory named by parts, creating it if needed."""
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'pybugz', *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def safe_name(name):
+    """Turn a connection name into something usable as a file name."""
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def json_default(value):
+    """Convert values json cannot store: compact bug records become
+    dictionaries, anything else, such as xmlrpc DateTime, a string.
+    """
+    if hasattr(value, 'as_dict'):
+        return value.as_dict()
+    return str(value)
+
+
+def load_json(path, default=None):
+    """Read a cache file, returning default if it is missing or broken."""
+    try:
+        with open(path, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Write a cache file atomically.
+
+    Values json cannot store are converted by json_default.
+    """
+    fd, name = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, default=json_default)
+    os.replace(name, path)
+
+
+def load_entry(path, ttl):
+    """Return the value saved by save_entry if it is younger than ttl
+    seconds, or None.  Reading an entry marks it as recently used.
+    """
+    entry = load_json(path)
+    if entry is None or time.time() - entry['time'] > ttl:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entry['value']
+
+
+def save_entry(path, value, max_entries):
+    """Save a value with its age, keeping at most max_entries entries in
+    the directory by removing the least recently used ones.
+    """
+    save_json(path, {'time': time.time(), 'value': value})
+
+    directory = os.path.dirname(path)
+    entries = []
+    for name in os.listdir(directory):
+        try:
+            entry = os.path.join(directory, name)
+            entries.append((os.stat(entry).st_mtime, entry))
+        except OSError:
+            pass
+    entries.sort()
+    for _, entry in entries[:max(len(entries) - max_entries, 0)]:
+        try:
+            os.unlink(entry)
+        except OSError:
+            pass
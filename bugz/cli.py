@@ -16,20 +16,72 @@ Classes
 
 """
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import getpass
+import hashlib
+import io
+import itertools
+import json
 import os
 import re
+import shlex
+import shutil
 import subprocess
 import sys
 import textwrap
+import time
 import xmlrpc.client
 
+from bugz.aio import AsyncBugzilla, run_coroutine
+from bugz.archive import ArchiveWriter
+from bugz.attachments import cached_digest, open_attachment, save_attachment
+from bugz.cache import cache_dir, load_entry, load_json, safe_name
+from bugz.cache import json_default, save_entry, save_json
 from bugz.cli_argparser import make_arg_parser
-from bugz.configfile import load_config
+from bugz.complete import remember_bugs
+from bugz.configfile import load_config, load_queries, save_queries
 from bugz.settings import Settings
 from bugz.exceptions import BugzError
-from bugz.log import log_error, log_info
-from bugz.utils import block_edit, get_content_type
+from bugz.index import index_bugs, open_index, search_index
+from bugz.journal import open_journal
+from bugz.log import log_debug, log_error, log_info, log_setOutput
+from bugz.log import log_warn
+from bugz.metadata import legal_values, load_metadata
+from bugz.metrics import CACHE_HITS, CACHE_MISSES, export_metrics
+from bugz.records import LIST_FIELDS, CompactUnmarshaller
+from bugz.session import load_session, login
+from bugz.transport import SpoolingUnmarshaller
+from bugz.utils import block_edit, get_content_type, input_choice
+
+SYNC_BATCH_SIZE = 100
+TREE_BATCH_SIZE = 500
+MODIFY_BATCH_SIZE = 50
+WRAP_CACHE_SIZE = 1000
+COUPLED_FIELDS = [['status', 'resolution'],
+                  ['product', 'component', 'version']]
+BATCH_WINDOW = 500
+MACHINE_FORMATS = ['csv', 'jsonl']
+
+# modify options which keep a line of bugz batch from being merged with
+# others: they need the terminal, a file or state of their own, or change
+# the connection
+BATCH_SEPARATE_OPTIONS = ['comment_editor', 'comment_from', 'journal',
+                          'resume', 'skip_unchanged', 'if_unchanged_since',
+                          'expect_from', 'config_file', 'connection',
+                          'base', 'user', 'password', 'passwordcmd', 'key',
+                          'skip_auth', 'insecure', 'interactive']
+
+WRAP_CACHE = collections.OrderedDict()
+
+# options of saved queries which are not Bug.search parameters
+QUERY_CONNECTION = 'connection'
+QUERY_OPTIONS = ['cache_ttl', 'incremental', 'show_status', 'show_priority',
+                 'show_severity']
 
 
 def check_bugz_token():
@@ -54,17 +106,34 @@ def check_bugz_token():
 
 def check_auth(settings):
     """Authenticate a session.
+
+    Unless an api key is used, the user logs in once and the session
+    token is reused by later runs until it is session_ttl seconds old.
     """
     if settings.skip_auth:
         for x in ['key', 'user', 'password']:
             if hasattr(settings, x):
                 delattr(settings, x)
-    elif settings.interactive:
-        # prompt for username if we were not supplied with it
-        if not hasattr(settings, 'user'):
-            log_info('No username given.')
-            settings.user = input('Username: ')
+        return
+
+    if hasattr(settings, 'key') or hasattr(settings, 'token'):
+        return
+
+    # prompt for username if we were not supplied with it
+    if settings.interactive and not hasattr(settings, 'user'):
+        log_info('No username given.')
+        settings.user = input('Username: ')
+
+    if settings.session_ttl and hasattr(settings, 'user'):
+        token = load_session(settings)
+        if token is not None:
+            log_debug('Using saved session', 1)
+            CACHE_HITS.inc(cache='session')
+            settings.token = token
+            return
+        CACHE_MISSES.inc(cache='session')
 
+    if settings.interactive:
         # prompt for password if we were not supplied with it
         if not hasattr(settings, 'password'):
             if not hasattr(settings, 'passwordcmd'):
@@ -74,7 +143,13 @@ def check_auth(settings):
                 process = subprocess.Popen(settings.passwordcmd, shell=True,
                         stdout=subprocess.PIPE)
                 password, _ = process.communicate()
-                settings.password = password.splitlines()[0]
+                settings.password = password.decode().splitlines()[0]
+
+    if settings.session_ttl and hasattr(settings, 'user') and \
+            hasattr(settings, 'password'):
+        token = login(settings)
+        if token is not None:
+            settings.token = token
 
 
 def list_bugs(buglist, settings):
@@ -86,6 +161,8 @@ def list_bugs(buglist, settings):
         assignee = bug['assigned_to'].split('@')[0]
         desc = bug['summary']
         line = '%s' % (bugid)
+        if hasattr(settings, 'search_connections'):
+            line = '%s:%s' % (settings.connection, line)
         if hasattr(settings, 'show_status'):
             line = '%s %-12s' % (line, status)
         if hasattr(settings, 'show_priority'):
@@ -99,15 +176,19 @@ def list_bugs(buglist, settings):
     log_info("%i bug(s) found." % len(buglist))
 
 
-def prompt_for_bug(settings):
+def prompt_for_bug(settings, metadata=None):
     """ Prompt for the information for a bug
+
+    If the legal field values are known, they are offered for tab
+    completion and the answers are checked against them.
     """
     log_info('Press Ctrl+C at any time to abort.')
 
     if not hasattr(settings, 'product'):
         product = None
         while not product or len(product) < 1:
-            product = input('Enter product: ')
+            product = input_choice('Enter product: ',
+                                   legal_values(metadata, 'product'))
         settings.product = product
     else:
         log_info('Enter product: %s' % settings.product)
@@ -115,13 +196,17 @@ def prompt_for_bug(settings):
     if not hasattr(settings, 'component'):
         component = None
         while not component or len(component) < 1:
-            component = input('Enter component: ')
+            component = input_choice('Enter component: ',
+                                     legal_values(metadata, 'component',
+                                                  settings.product))
         settings.component = component
     else:
         log_info('Enter component: %s' % settings.component)
 
     if not hasattr(settings, 'version'):
-        line = input('Enter version (default: unspecified): ')
+        line = input_choice('Enter version (default: unspecified): ',
+                            legal_values(metadata, 'version',
+                                         settings.product))
         settings.version = line or 'unspecified'
     else:
         log_info('Enter version: %s' % settings.version)
@@ -143,7 +228,7 @@ def prompt_for_bug(settings):
 
     if not hasattr(settings, 'op_sys'):
         op_sys_msg = 'Enter operating system where this bug occurs: '
-        line = input(op_sys_msg)
+        line = input_choice(op_sys_msg, legal_values(metadata, 'op_sys'))
         if len(line):
             settings.op_sys = line
     else:
@@ -151,7 +236,8 @@ def prompt_for_bug(settings):
 
     if not hasattr(settings, 'platform'):
         platform_msg = 'Enter hardware platform where this bug occurs: '
-        line = input(platform_msg)
+        line = input_choice(platform_msg,
+                            legal_values(metadata, 'platform'))
         if len(line):
             settings.platform = line
     else:
@@ -159,7 +245,8 @@ def prompt_for_bug(settings):
 
     if not hasattr(settings, 'priority'):
         priority_msg = 'Enter priority (eg. Normal) (optional): '
-        line = input(priority_msg)
+        line = input_choice(priority_msg,
+                            legal_values(metadata, 'priority'))
         if len(line):
             settings.priority = line
     else:
@@ -167,7 +254,8 @@ def prompt_for_bug(settings):
 
     if not hasattr(settings, 'severity'):
         severity_msg = 'Enter severity (eg. normal) (optional): '
-        line = input(severity_msg)
+        line = input_choice(severity_msg,
+                            legal_values(metadata, 'severity'))
         if len(line):
             settings.severity = line
     else:
@@ -220,7 +308,47 @@ def prompt_for_bug(settings):
         log_info('Append command (optional): %s' % settings.append_command)
 
 
-def show_bug_info(bug, settings):
+def check_field_values(settings, metadata):
+    """Check the fields of a new bug against their legal values, so a
+    typo is reported before the bug is submitted.
+    """
+    for field in ['product', 'component', 'version', 'op_sys', 'platform',
+                  'priority', 'severity']:
+        value = getattr(settings, field, None)
+        choices = legal_values(metadata, field,
+                               getattr(settings, 'product', None))
+        if value is not None and choices and value not in choices:
+            raise BugzError('%s is not a valid %s, choose one of: %s' %
+                            (value, field, ', '.join(choices)))
+
+
+def fetch_bug_details(settings, bz, ids):
+    """Fetch the attachments and comments of several bugs at once.
+
+    Returns a dictionary mapping each bug id to a dictionary with the
+    'attachments' and 'comments' lists which are wanted by show_bug_info.
+    """
+    details = {}
+    for bugid in ids:
+        details[bugid] = {}
+
+    if not hasattr(settings, 'no_attachments'):
+        params = {'ids': ids, 'exclude_fields': ['data']}
+        result = settings.call_bz(bz.Bug.attachments, params)
+        for bugid in ids:
+            details[bugid]['attachments'] = result['bugs']['%s' % bugid]
+
+    if not hasattr(settings, 'no_comments'):
+        params = {'ids': ids}
+        result = settings.call_bz(bz.Bug.comments, params)
+        for bugid in ids:
+            details[bugid]['comments'] = \
+                result['bugs']['%s' % bugid]['comments']
+
+    return details
+
+
+def show_bug_info(bug, settings, details=None):
     FieldMap = {
         'alias': 'Alias',
         'summary': 'Title',
@@ -268,10 +396,12 @@ def show_bug_info(bug, settings):
         elif value is not None and value != '':
             print('%-12s: %s' % (desc, value))
 
+    if details is None:
+        details = fetch_bug_details(settings, settings.bz, [bug['id']])
+        details = details[bug['id']]
+
     if not hasattr(settings, 'no_attachments'):
-        params = {'ids': [bug['id']]}
-        bug_attachments = settings.call_bz(settings.bz.Bug.attachments, params)
-        bug_attachments = bug_attachments['bugs']['%s' % bug['id']]
+        bug_attachments = details['attachments']
         print('%-12s: %d' % ('Attachments', len(bug_attachments)))
         print()
         for attachment in bug_attachments:
@@ -281,34 +411,54 @@ def show_bug_info(bug, settings):
             print('[Attachment] [%s] [%s]' % (aid, desc))
 
     if not hasattr(settings, 'no_comments'):
-        params = {'ids': [bug['id']]}
-        bug_comments = settings.call_bz(settings.bz.Bug.comments, params)
-        bug_comments = bug_comments['bugs']['%s' % bug['id']]['comments']
+        bug_comments = details['comments']
         print('%-12s: %d' % ('Comments', len(bug_comments)))
         print()
-        i = 0
-        wrapper = textwrap.TextWrapper(width=settings.columns,
-                                       break_long_words=False,
-                                       break_on_hyphens=False)
-        for comment in bug_comments:
-            who = comment['creator']
-            when = comment['time']
-            what = comment['text']
-            print('[Comment #%d] %s : %s' % (i, who, when))
-            print('-' * (settings.columns - 1))
-
-            if what is None:
-                what = ''
-
-            # print wrapped version
-            for line in what.splitlines():
-                if len(line) < settings.columns:
-                    print(line)
-                else:
-                    for shortline in wrapper.wrap(line):
-                        print(shortline)
-            print()
-            i += 1
+        sys.stdout.writelines(render_comments(bug_comments, settings.columns,
+                                              sys.stdout.isatty()))
+
+
+def render_comments(comments, columns, wrap=True):
+    """Yield the text of comments as it is written out.
+
+    Comments are only wrapped for a terminal, and wrapped comments are
+    kept in WRAP_CACHE so showing a bug again does not wrap them again.
+    """
+    for i, comment in enumerate(comments):
+        yield '[Comment #%d] %s : %s\n' % (i, comment['creator'],
+                                            comment['time'])
+        yield '-' * (columns - 1) + '\n'
+        if wrap:
+            yield wrap_comment(comment, columns)
+        else:
+            for line in (comment['text'] or '').splitlines():
+                yield line + '\n'
+        yield '\n'
+
+
+def wrap_comment(comment, columns):
+    """Return the text of a comment wrapped to columns."""
+    key = (comment.get('id'), columns)
+    if key in WRAP_CACHE:
+        WRAP_CACHE.move_to_end(key)
+        return WRAP_CACHE[key]
+
+    wrapper = textwrap.TextWrapper(width=columns,
+                                   break_long_words=False,
+                                   break_on_hyphens=False)
+    lines = []
+    for line in (comment['text'] or '').splitlines():
+        if len(line) < columns:
+            lines.append(line)
+        else:
+            lines.extend(wrapper.wrap(line))
+    text = ''.join(line + '\n' for line in lines)
+
+    if key[0] is not None:
+        WRAP_CACHE[key] = text
+        if len(WRAP_CACHE) > WRAP_CACHE_SIZE:
+            WRAP_CACHE.popitem(last=False)
+    return text
 
 
 def attach(settings):
@@ -336,7 +486,8 @@ def attach(settings):
     params['ids'] = [bugid]
 
     with open(filename, 'rb') as fd:
-        params['data'] = xmlrpc.client.Binary(fd.read())
+        data = fd.read()
+    params['data'] = xmlrpc.client.Binary(data)
 
     params['file_name'] = os.path.basename(filename)
     params['summary'] = summary
@@ -345,24 +496,110 @@ def attach(settings):
     if is_patch is not None:
         params['is_patch'] = is_patch
     check_auth(settings)
+
+    if not hasattr(settings, 'force'):
+        attachid = find_attachment(settings, bugid, params['file_name'],
+                                   data)
+        if attachid is not None:
+            log_info('{0} is already attached to bug {1} as {2}, skipped '
+                     '(use --force to attach it again)'.format(
+                         filename, bugid, attachid))
+            return
+
     result = settings.call_bz(settings.bz.Bug.add_attachment, params)
     attachid = result['ids'][0]
     log_info('{0} ({1}) has been attached to bug {2}'.format(
         filename, attachid, bugid))
 
+    # cache the new attachment, so it is known without downloading it
+    info = dict((key, params[key]) for key in
+                ['file_name', 'summary', 'content_type'])
+    info.update(id=attachid, bug_id=bugid, size=len(data))
+    save_attachment(settings, attachid, info, io.BytesIO(data))
+
+
+def find_attachment(settings, bugid, filename, data):
+    """Return the id of an attachment of a bug which is the same as the
+    file, or None.
+
+    Only the attachments of the same size are compared, by the sha256
+    of their content in the attachment cache, and nothing is downloaded.
+    An attachment with the same name and size which is not cached cannot
+    be compared, so it is only warned about.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    result = settings.call_bz(settings.bz.Bug.attachments,
+                              {'ids': [bugid], 'exclude_fields': ['data']})
+    for attachments in result['bugs'].values():
+        for attachment in attachments:
+            if attachment.get('size', len(data)) != len(data):
+                continue
+            other = cached_digest(settings, attachment['id'])
+            if other == digest:
+                return attachment['id']
+            if other is None and attachment['file_name'] == filename:
+                log_warn('bug {0} has an attachment {1} of the same name '
+                         'and size, which may be the same file'.format(
+                             bugid, attachment['id']))
+    return None
+
+
+def fetch_attachment(settings, attachid):
+    """Return the info of an attachment, its data as a binary file and
+    its sha256, from the attachment cache if possible.
+
+    The data is spooled to a temporary file while it is downloaded.
+    """
+    cached = open_attachment(settings, attachid)
+    if cached is not None:
+        CACHE_HITS.inc(cache='attachment')
+        info, fd = cached
+        return info, fd, info['sha256']
+
+    CACHE_MISSES.inc(cache='attachment')
+    check_auth(settings)
+
+    bz = settings.make_proxy(SpoolingUnmarshaller)
+    result = settings.call_bz(bz.Bug.attachments,
+                              {'attachment_ids': [attachid]})
+    info = result['attachments']['%s' % attachid]
+    fd = info.pop('data')
+    digest = save_attachment(settings, attachid, info, fd)
+    fd.seek(0)
+    return info, fd, digest
+
+
+def check_attachment_size(settings, attachid):
+    """Refuse to view an attachment larger than max_attachment_size."""
+    cached = open_attachment(settings, attachid)
+    if cached is not None:
+        size = os.fstat(cached[1].fileno()).st_size
+        cached[1].close()
+    else:
+        check_auth(settings)
+        result = settings.call_bz(settings.bz.Bug.attachments,
+                                  {'attachment_ids': [attachid],
+                                   'include_fields': ['size']})
+        size = result['attachments']['%s' % attachid]['size']
+    if size > settings.max_attachment_size:
+        raise BugzError('Attachment {0} is {1} bytes, larger than '
+                        'max_attachment_size ({2} bytes). Save it to a file, '
+                        'or use --head, --tail or --grep, instead of viewing '
+                        'it.'.format(attachid, size,
+                                     settings.max_attachment_size))
+
 
 def attachment(settings):
     """ Download or view an attachment given the id."""
     log_info('Getting attachment %s' % settings.attachid)
 
-    params = {}
-    params['attachment_ids'] = [settings.attachid]
-
-    check_auth(settings)
+    preview = hasattr(settings, 'head') or hasattr(settings, 'tail') or \
+        hasattr(settings, 'grep')
+    view = hasattr(settings, 'view') or preview
+    if view and not preview and settings.max_attachment_size:
+        check_attachment_size(settings, settings.attachid)
 
-    result = settings.call_bz(settings.bz.Bug.attachments, params)
-    result = result['attachments'][settings.attachid]
-    view = hasattr(settings, 'view')
+    result, data, _ = fetch_attachment(settings, settings.attachid)
 
     action = {True: 'Viewing', False: 'Saving'}
     log_info('%s attachment: "%s"' %
@@ -370,14 +607,42 @@ def attachment(settings):
     safe_filename = os.path.basename(re.sub(r'\.\.', '',
                                             result['file_name']))
 
-    if view:
-        print(result['data'].data.decode('utf-8'))
-    else:
-        if os.path.exists(result['file_name']):
-            raise RuntimeError('Filename already exists')
+    with data:
+        if preview:
+            preview_attachment(settings, data)
+        elif view:
+            text = io.TextIOWrapper(data, encoding='utf-8')
+            shutil.copyfileobj(text, sys.stdout)
+            print()
+        else:
+            if os.path.exists(result['file_name']):
+                raise RuntimeError('Filename already exists')
 
-        with open(safe_filename, 'wb') as fd:
-            fd.write(result['data'].data)
+            with open(safe_filename, 'wb') as fd:
+                shutil.copyfileobj(data, fd)
+
+
+def preview_attachment(settings, data):
+    """Print the first or last lines of an attachment, or the lines
+    matching a pattern, reading it a line at a time.
+    """
+    if hasattr(settings, 'grep'):
+        try:
+            pattern = re.compile(settings.grep)
+        except re.error as error:
+            raise BugzError('invalid pattern: %s' % error)
+
+    lines = io.TextIOWrapper(data, encoding='utf-8', errors='replace')
+    if hasattr(settings, 'grep'):
+        lines = ('%d: %s' % (number, line)
+                 for number, line in enumerate(lines, 1)
+                 if pattern.search(line) is not None)
+    if hasattr(settings, 'head'):
+        lines = itertools.islice(lines, settings.head)
+    if hasattr(settings, 'tail'):
+        lines = collections.deque(lines, maxlen=settings.tail)
+    for line in lines:
+        sys.stdout.write(line if line.endswith('\n') else line + '\n')
 
 
 def get(settings):
@@ -388,8 +653,245 @@ def get(settings):
     params = {'ids': [settings.bugid]}
     result = settings.call_bz(settings.bz.Bug.get, params)
 
+    ids = [bug['id'] for bug in result['bugs']]
+    details = fetch_bug_details(settings, settings.bz, ids)
     for bug in result['bugs']:
-        show_bug_info(bug, settings)
+        show_bug_info(bug, settings, details[bug['id']])
+    remember_bugs(settings, result['bugs'])
+
+    if settings.local_index:
+        comments = {}
+        if not hasattr(settings, 'no_comments'):
+            for bugid in ids:
+                comments[bugid] = details[bugid]['comments']
+        db = open_index(settings)
+        index_bugs(db, result['bugs'], comments)
+        db.close()
+
+
+def grep(settings):
+    """Print the lines of the comments of bugs matching a pattern.
+
+    The comments of all the bugs are fetched with one Bug.comments call
+    and only the matching lines are printed, with the bug, the comment
+    number, its author and time.
+    """
+    flags = re.IGNORECASE if hasattr(settings, 'ignore_case') else 0
+    try:
+        pattern = re.compile(settings.pattern, flags)
+    except re.error as error:
+        raise BugzError('invalid pattern: %s' % error)
+
+    check_auth(settings)
+
+    result = settings.call_bz(settings.bz.Bug.comments,
+                              {'ids': settings.bugid})
+
+    # bugs are returned by their number, so aliases are looked up
+    names = {}
+    for bugid in settings.bugid:
+        names[bugid] = normalize_bugid(bugid)
+    unmatched = [x for x in settings.bugid if names[x] not in result['bugs']]
+    if unmatched:
+        bugs = settings.call_bz(settings.bz.Bug.get, {
+            'ids': unmatched,
+            'include_fields': ['id', 'alias'],
+            'permissive': True,
+        })['bugs']
+        found = bug_names(bugs)
+        for bugid in unmatched:
+            if bugid in found:
+                names[bugid] = '%s' % found[bugid]['id']
+
+    for bugid in settings.bugid:
+        comments = result['bugs'].get(names[bugid])
+        if comments is None:
+            log_error('Bug %s not found' % bugid)
+            continue
+        for i, comment in enumerate(comments['comments']):
+            text = comment['text'] or ''
+            if pattern.search(text) is None:
+                continue
+            for line in text.splitlines():
+                if pattern.search(line) is not None:
+                    print('%s [Comment #%d] %s : %s: %s' %
+                          (bugid, i, comment['creator'], comment['time'],
+                           line))
+
+
+def fetch_tree(settings, field):
+    """Walk the bugs linked through field breadth first.
+
+    Each level of the tree is fetched with one Bug.get call per
+    TREE_BATCH_SIZE bugs, asking only for the fields needed to draw it.
+    Returns the id of the root bug and a dictionary of the bugs found.
+    """
+    max_depth = getattr(settings, 'depth', None)
+    fields = ['id', 'status', 'summary', field]
+    nodes = {}
+    root = None
+    frontier = [settings.bugid]
+    depth = 0
+    while frontier:
+        level = []
+        for start in range(0, len(frontier), TREE_BATCH_SIZE):
+            params = {'ids': frontier[start:start + TREE_BATCH_SIZE],
+                      'include_fields': fields,
+                      'permissive': True}
+            result = settings.call_bz(settings.bz.Bug.get, params)
+            for bug in result['bugs']:
+                nodes[bug['id']] = bug
+                level.append(bug['id'])
+        if root is None:
+            if not level:
+                raise BugzError('Bug %s not found' % settings.bugid)
+            root = level[0]
+        log_info('Fetched %d bug(s) at depth %d' % (len(level), depth))
+
+        if max_depth is not None and depth >= max_depth:
+            break
+        frontier = []
+        queued = set()
+        for bugid in level:
+            for child in nodes[bugid][field]:
+                if child not in nodes and child not in queued:
+                    queued.add(child)
+                    frontier.append(child)
+        depth += 1
+    return root, nodes
+
+
+def tree(settings):
+    """Show the bugs a bug depends on or blocks as a tree."""
+    field = {'depends': 'depends_on', 'blocks': 'blocks'}[settings.direction]
+
+    check_auth(settings)
+
+    log_info('Getting the %s tree of bug %s ..' %
+             (settings.direction, settings.bugid))
+    root, nodes = fetch_tree(settings, field)
+
+    if hasattr(settings, 'dot'):
+        print('digraph bugs {')
+        for bugid in sorted(nodes):
+            bug = nodes[bugid]
+            label = '%s %s\\n%s' % (bugid, bug['status'], bug['summary'])
+            label = label.replace('"', '\\"')
+            print('    %s [label="%s"];' % (bugid, label))
+            for child in bug[field]:
+                if child in nodes:
+                    print('    %s -> %s;' % (bugid, child))
+        print('}')
+        return
+
+    # the bugs below --depth are not fetched, and are counted in one
+    # line per bug instead of being listed
+    shown = set()
+    stack = [(root, 0)]
+    while stack:
+        bugid, depth = stack.pop()
+        indent = '  ' * depth
+        if isinstance(bugid, tuple):
+            line = '%s(%d more not fetched)' % (indent, bugid[1])
+        elif bugid in shown:
+            line = '%s%s (see above)' % (indent, bugid)
+        else:
+            shown.add(bugid)
+            bug = nodes[bugid]
+            line = '%s%s %-12s %s' % (indent, bugid, bug['status'],
+                                      bug['summary'])
+            missing = len([x for x in bug[field] if x not in nodes])
+            if missing:
+                stack.append((('more', missing), depth + 1))
+            for child in reversed(bug[field]):
+                if child in nodes:
+                    stack.append((child, depth + 1))
+        print(line[:settings.columns] if settings.columns else line)
+
+    log_info('%d bug(s) in the tree.' % len(nodes))
+
+
+def fetch_history(settings, ids):
+    """Fetch the history of several bugs, using the local history cache.
+
+    History entries never change once written, so only the entries newer
+    than the last one cached are requested.  Bugs without a cache are
+    fetched together in one call, and bugs with one in a second call.
+    Returns the number and history of each bug found, like Bug.history
+    does, keyed by the id or alias the bug was given by.
+    """
+    directory = cache_dir('history', safe_name(settings.connection))
+    history = {}
+    names = {}
+    since = None
+    for bugid in ids:
+        name = normalize_bugid(bugid)
+        if not name.isdigit():
+            # the number of an alias is only known from the server
+            continue
+        entries = load_json(os.path.join(directory, '%s.json' % name))
+        if entries:
+            history[name] = entries
+            names[bugid] = name
+            if since is None or entries[-1]['when'] < since:
+                since = entries[-1]['when']
+
+    calls = []
+    uncached = [x for x in ids if x not in names]
+    if uncached:
+        calls.append({'ids': uncached})
+    if history:
+        calls.append({'ids': list(history),
+                      'new_since': xmlrpc.client.DateTime(since)})
+
+    for params in calls:
+        result = settings.call_bz(settings.bz.Bug.history, params)
+        found = bug_names(result['bugs'])
+        for bugid in params['ids']:
+            name = normalize_bugid(bugid)
+            if name in found:
+                names[bugid] = '%s' % found[name]['id']
+        for bug in result['bugs']:
+            bugid = '%s' % bug['id']
+            entries = history.get(bugid, [])
+            seen = set(json.dumps(x, sort_keys=True) for x in entries)
+            for entry in json.loads(json.dumps(bug['history'], default=str)):
+                if json.dumps(entry, sort_keys=True) not in seen:
+                    entries.append(entry)
+            history[bugid] = entries
+            save_json(os.path.join(directory, '%s.json' % bugid), entries)
+
+    return dict((bugid, {'id': int(name), 'history': history[name]})
+                for bugid, name in names.items())
+
+
+def history(settings):
+    """Show the change history of bugs"""
+    check_auth(settings)
+
+    log_info('Getting the history of bug(s) %s ..' % ', '.join(settings.bugid))
+    result = fetch_history(settings, settings.bugid)
+
+    for bugid in settings.bugid:
+        if bugid not in result:
+            log_error('No history found for bug %s' % bugid)
+            continue
+        entries = result[bugid]['history']
+        if settings.format == 'jsonl':
+            for entry in entries:
+                entry = dict(entry, bug_id=result[bugid]['id'])
+                print(json.dumps(entry, sort_keys=True))
+            continue
+        print('%-12s: %s' % ('Bug', result[bugid]['id']))
+        print('%-12s: %d' % ('Changes', len(entries)))
+        print()
+        for entry in entries:
+            print('[Change] %s : %s' % (entry['who'], entry['when']))
+            for change in entry['changes']:
+                print('%-20s: %s -> %s' % (change['field_name'],
+                                           change['removed'],
+                                           change['added']))
+            print()
 
 
 def modify(settings):
@@ -405,15 +907,192 @@ def modify(settings):
             raise BugzError('unable to read file: %s: %s' %
                             (settings.comment_from, error))
 
+    if hasattr(settings, 'comment_editor'):
+        settings.comment = block_edit('Enter comment:')
+
+    params = modify_params(settings)
+    if not params:
+        raise BugzError('No changes were specified')
+
+    ids = settings.bugid
+    journal = open_journal(settings, 'modify', [ids, params])
+    if journal is not None:
+        ids = [x for x in ids if '%s' % x not in journal.done]
+        if len(ids) < len(settings.bugid):
+            log_info('Skipping %d bugs already modified' %
+                     (len(settings.bugid) - len(ids)))
+        if not ids:
+            return
+
+    check_auth(settings)
+
+    expected = expected_change_times(settings, ids)
+    if expected:
+        ids = unchanged_bugs(settings, ids, expected)
+        if not ids:
+            return
+
+    if hasattr(settings, 'skip_unchanged'):
+        updates, skipped = minimal_updates(settings, ids, params)
+        for bugid in skipped:
+            log_info('Bug %s already has these values, skipped' % bugid)
+        if journal is not None and skipped:
+            journal.record(skipped, None)
+    else:
+        updates = [(ids, params)]
+
+    for ids, params in updates:
+        # with a journal, bugs are updated and recorded in batches so
+        # an interrupted run loses little work
+        step = MODIFY_BATCH_SIZE if journal is not None else len(ids)
+        for start in range(0, len(ids), step):
+            params['ids'] = ids[start:start + step]
+            result = settings.call_bz(settings.bz.Bug.update, params)
+            log_changes(result)
+            if journal is not None:
+                journal.record(params['ids'], result['bugs'])
+
+    if journal is not None:
+        journal.close()
+
+
+def normalize_time(value):
+    """Turn a timestamp such as 2024-01-31T12:00:00Z, 2024-01-31 12:00:00
+    or Bugzilla's 20240131T12:00:00 into comparable YYYYMMDDHHMMSS form.
+    """
+    digits = re.sub(r'\D', '', '%s' % value)
+    if len(digits) != 14:
+        raise BugzError('invalid timestamp: %s' % value)
+    return digits
+
+
+def normalize_bugid(bugid):
+    """Turn a bug number such as 04 into the form the server uses."""
+    name = '%s' % bugid
+    return '%d' % int(name) if name.isdigit() else name
+
+
+def bug_names(bugs):
+    """Map the numbers and aliases of bugs to the bugs."""
+    found = {}
+    for bug in bugs:
+        found['%s' % bug['id']] = bug
+        alias = bug.get('alias') or []
+        for name in alias if isinstance(alias, list) else [alias]:
+            found[name] = bug
+    return found
+
+
+def match_bugs(ids, bugs):
+    """Map each bug id or alias in ids to its bug in bugs.
+
+    The server returns bugs by their number, whatever they were asked
+    for by, so ids such as 04 and aliases are matched here.
+    """
+    found = bug_names(bugs)
+    matched = {}
+    missing = []
+    for bugid in ids:
+        name = normalize_bugid(bugid)
+        if name in found:
+            matched[bugid] = found[name]
+        else:
+            missing.append('%s' % bugid)
+    if missing:
+        raise BugzError('Bugs not found: %s' % ', '.join(missing))
+    return matched
+
+
+def expected_change_times(settings, ids):
+    """Return the time each bug is expected to have been changed last,
+    from --if-unchanged-since and --expect-from, or None.
+    """
+    if not hasattr(settings, 'if_unchanged_since') and \
+            not hasattr(settings, 'expect_from'):
+        return None
+
+    expected = {}
+    if hasattr(settings, 'if_unchanged_since'):
+        since = normalize_time(settings.if_unchanged_since)
+        for bugid in ids:
+            expected[normalize_bugid(bugid)] = since
+
+    if hasattr(settings, 'expect_from'):
+        try:
+            with open(settings.expect_from) as fd:
+                for line in fd:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line.startswith('{'):
+                        bug = json.loads(line)
+                        bugid, when = bug['id'], bug['last_change_time']
+                    else:
+                        bugid, when = line.split(None, 1)
+                    expected[normalize_bugid(bugid)] = normalize_time(when)
+        except (OSError, ValueError, KeyError) as error:
+            raise BugzError('unable to read file: %s: %s' %
+                            (settings.expect_from, error))
+    return expected
+
+
+def unchanged_bugs(settings, ids, expected):
+    """Return the bugs which were not changed after their expected time.
+
+    The last change times of all bugs are fetched with one Bug.get.  The
+    check and the update are separate calls, so a change made between
+    them is not detected.
+    """
+    result = settings.call_bz(settings.bz.Bug.get, {
+        'ids': ids,
+        'include_fields': ['id', 'alias', 'last_change_time'],
+    })
+
+    bugs = match_bugs(ids, result['bugs'])
+
+    # expected times may name a bug by its number or by what was given
+    times = {}
+    for bugid in ids:
+        for name in [normalize_bugid(bugid), '%s' % bugs[bugid]['id']]:
+            if name in expected:
+                times[bugid] = expected[name]
+                break
+    missing = ['%s' % x for x in ids if x not in times]
+    if missing:
+        raise BugzError('No expected change time for bugs: %s' %
+                        ', '.join(missing))
+
+    unchanged = []
+    for bugid in ids:
+        changed = bugs[bugid]['last_change_time']
+        if normalize_time(changed) <= times[bugid]:
+            unchanged.append(bugid)
+        else:
+            log_info('Bug %s was changed at %s, skipped' % (bugid, changed))
+    return unchanged
+
+
+def log_changes(result):
+    """Log the changes reported by Bug.update."""
+    for bug in result['bugs']:
+        changes = bug['changes']
+        if not len(changes):
+            log_info('Added comment to bug %s' % bug['id'])
+        else:
+            log_info('Modified the following fields in bug %s' % bug['id'])
+            for key in changes:
+                log_info('%-12s: removed %s' %
+                         (key, changes[key]['removed']))
+                log_info('%-12s: added %s' % (key, changes[key]['added']))
+
+
+def modify_params(settings):
+    """Build the parameters of Bug.update, without the bug ids."""
     if hasattr(settings, 'assigned_to') and \
             hasattr(settings, 'reset_assigned_to'):
         raise BugzError('--assigned-to and --unassign cannot be used together')
 
-    if hasattr(settings, 'comment_editor'):
-        settings.comment = block_edit('Enter comment:')
-
     params = {}
-    params['ids'] = [settings.bugid]
     if hasattr(settings, 'alias'):
         params['alias'] = settings.alias
     if hasattr(settings, 'assigned_to'):
@@ -511,19 +1190,79 @@ def modify(settings):
         params['status'] = 'RESOLVED'
         params['resolution'] = 'INVALID'
 
-    if len(params) < 2:
-        raise BugzError('No changes were specified')
-    check_auth(settings)
-    result = settings.call_bz(settings.bz.Bug.update, params)
-    for bug in result['bugs']:
-        changes = bug['changes']
-        if not len(changes):
-            log_info('Added comment to bug %s' % bug['id'])
-        else:
-            log_info('Modified the following fields in bug %s' % bug['id'])
-            for key in changes:
-                log_info('%-12s: removed %s' % (key, changes[key]['removed']))
-                log_info('%-12s: added %s' % (key, changes[key]['added']))
+    return params
+
+
+def minimal_updates(settings, ids, params):
+    """Leave out of an update the values the bugs already have.
+
+    The current values of the touched fields are fetched for all bugs
+    with one Bug.get call.  Bugs needing the same changes are grouped,
+    so one Bug.update is sent per distinct set of changes.  Returns the
+    list of (ids, params) updates and the list of bugs left unchanged,
+    both naming the bugs as they were given in ids.
+    """
+    fields = [x for x in params if x not in ['comment', 'work_time']]
+    result = settings.call_bz(settings.bz.Bug.get, {
+        'ids': ids,
+        'include_fields': ['id', 'alias'] + fields,
+    })
+    bugs = match_bugs(ids, result['bugs'])
+
+    def same(current, value):
+        if not isinstance(current, list):
+            current = [current]
+        return ['%s' % x for x in current] == ['%s' % value]
+
+    def contains(current, value):
+        return '%s' % value in ['%s' % x for x in current]
+
+    updates = {}
+    skipped = []
+    for bugid in ids:
+        bug = bugs[bugid]
+        delta = {}
+        for key, value in params.items():
+            if key in ['comment', 'work_time']:
+                delta[key] = value
+            elif isinstance(value, dict):
+                current = bug.get(key) or []
+                change = {}
+                if 'add' in value:
+                    add = [x for x in value['add'] if not contains(current, x)]
+                    if add:
+                        change['add'] = add
+                if 'remove' in value:
+                    remove = [x for x in value['remove']
+                              if contains(current, x)]
+                    if remove:
+                        change['remove'] = remove
+                if 'set' in value:
+                    if sorted('%s' % x for x in current) != \
+                            sorted('%s' % x for x in value['set']):
+                        change['set'] = value['set']
+                if change:
+                    delta[key] = change
+            elif not same(bug.get(key), value):
+                delta[key] = value
+
+        # some fields are only valid together with the others of their
+        # group, eg. a component belongs to a product
+        for group in COUPLED_FIELDS:
+            if any(key in delta for key in group):
+                for key in group:
+                    if key in params:
+                        delta[key] = params[key]
+
+        if not delta:
+            skipped.append(bugid)
+            continue
+        group = json.dumps(delta, sort_keys=True)
+        if group not in updates:
+            updates[group] = ([], delta)
+        updates[group][0].append(bugid)
+
+    return list(updates.values()), skipped
 
 
 def post(settings):
@@ -541,8 +1280,10 @@ def post(settings):
             raise BugzError('Unable to read from file: %s: %s' %
                             (settings.description_from, error))
 
+    metadata = load_metadata(settings)
+
     if not hasattr(settings, 'batch'):
-        prompt_for_bug(settings)
+        prompt_for_bug(settings, metadata)
 
     # raise an exception if mandatory fields are not specified.
     if not hasattr(settings, 'product'):
@@ -553,6 +1294,7 @@ def post(settings):
         raise RuntimeError('Title not specified')
     if not hasattr(settings, 'description'):
         raise RuntimeError('Description not specified')
+    check_field_values(settings, metadata)
 
     # append the output from append_command to the description
     append_command = getattr(settings, 'append_command', None)
@@ -631,10 +1373,8 @@ def post(settings):
     log_info('Bug %d submitted' % result['id'])
 
 
-def search(settings):
-    """Performs a search on the bugzilla database with
-the keywords given on the title (or the body if specified).
-    """
+def search_params(settings):
+    """Build the parameters of Bug.search from the search options."""
     valid_keys = ['alias', 'assigned_to', 'component', 'creator',
                   'limit', 'offset', 'op_sys', 'platform',
                   'priority', 'product', 'resolution', 'severity',
@@ -654,13 +1394,171 @@ the keywords given on the title (or the body if specified).
     if not params:
         raise BugzError('Please give search terms or options.')
 
+    return params
+
+
+def cached_search(settings, params):
+    """Run Bug.search, answering from the search cache when possible.
+
+    Results are cached for search_cache_ttl seconds, keyed on the
+    parameters, the Bugzilla and the identity used to log in.
+    """
+    if hasattr(settings, 'compact'):
+        bz = settings.make_proxy(CompactUnmarshaller)
+    else:
+        bz = settings.bz
+
+    if not settings.search_cache_ttl or hasattr(settings, 'no_cache'):
+        return settings.call_bz(bz.Bug.search, params)['bugs']
+
+    key = json.dumps([settings.base, getattr(settings, 'key', None),
+                      getattr(settings, 'user', None), params],
+                     sort_keys=True, default=str)
+    path = os.path.join(cache_dir('search', safe_name(settings.connection)),
+                        '%s.json' % hashlib.sha256(key.encode()).hexdigest())
+
+    if not hasattr(settings, 'refresh'):
+        result = load_entry(path, settings.search_cache_ttl)
+        if result is not None:
+            log_info('Using cached search results')
+            CACHE_HITS.inc(cache='search')
+            return result
+
+    CACHE_MISSES.inc(cache='search')
+    result = settings.call_bz(bz.Bug.search, params)['bugs']
+    save_entry(path, result, settings.search_cache_size)
+    return result
+
+
+def cap_search(settings, params):
+    """Limit a search without --limit to one bug more than
+    max_search_results, and tell whether it was limited.
+    """
+    if not settings.max_search_results or 'limit' in params:
+        return False
+    params['limit'] = settings.max_search_results + 1
+    return True
+
+
+def check_search_results(settings, count):
+    if count > settings.max_search_results:
+        raise BugzError('The search matches more than max_search_results '
+                        '({0}) bugs. Narrow it or page through it with '
+                        '--limit and --offset.'.format(
+                            settings.max_search_results))
+
+
+def search_bugs(settings, params):
+    """Run Bug.search, limited by max_search_results like bugz search."""
+    params = dict(params)
+    capped = cap_search(settings, params)
+    result = settings.call_bz(settings.bz.Bug.search, params)['bugs']
+    if capped:
+        check_search_results(settings, len(result))
+    return result
+
+
+def search(settings):
+    """Performs a search on the bugzilla database with
+the keywords given on the title (or the body if specified).
+    """
+    if hasattr(settings, 'local'):
+        search_local(settings)
+        return
+
+    if hasattr(settings, 'search_connections'):
+        search_connections(settings)
+        return
+
+    params = search_params(settings)
+
     log_info('Searching for bugs meeting the following criteria:')
     for key in params:
         log_info('   {0:<20} = {1}'.format(key, params[key]))
 
     check_auth(settings)
 
-    result = settings.call_bz(settings.bz.Bug.search, params)['bugs']
+    if hasattr(settings, 'compact'):
+        params['include_fields'] = list(LIST_FIELDS)
+    capped = cap_search(settings, params)
+    result = cached_search(settings, params)
+    if capped:
+        check_search_results(settings, len(result))
+
+    if not len(result):
+        log_info('No bugs found.')
+    else:
+        list_bugs(result, settings)
+
+
+def search_connections(settings):
+    """Run the same search on several connections at the same time.
+
+    The searches run on one event loop with the asyncio client, and
+    the results of each bug tracker are listed as soon as it answers,
+    each bug id prefixed with the name of its connection.
+    """
+    trackers = []
+    for connection in settings.search_connections:
+        if connection not in settings.connections:
+            raise BugzError('connection "%s" not found' % connection)
+        tracker = settings.for_connection(connection)
+        check_auth(tracker)
+        trackers.append(tracker)
+
+    failed = []
+
+    async def run_search(client):
+        try:
+            params = search_params(client.settings)
+            if hasattr(settings, 'compact'):
+                params['include_fields'] = list(LIST_FIELDS)
+            capped = cap_search(client.settings, params)
+            result = await client.call('Bug.search', params)
+            if capped:
+                check_search_results(client.settings, len(result['bugs']))
+            return client.settings, result['bugs']
+        except BugzError as error:
+            log_error('[%s] %s' % (client.settings.connection, error))
+            failed.append(client.settings.connection)
+            return client.settings, None
+
+    async def run_searches():
+        unmarshaller = xmlrpc.client.Unmarshaller
+        if hasattr(settings, 'compact'):
+            unmarshaller = CompactUnmarshaller
+        clients = [AsyncBugzilla(tracker, unmarshaller=unmarshaller)
+                   for tracker in trackers]
+        try:
+            for future in asyncio.as_completed([run_search(client)
+                                                for client in clients]):
+                tracker, result = await future
+                if result is None:
+                    continue
+                if not len(result):
+                    log_info('[%s] No bugs found.' % tracker.connection)
+                else:
+                    list_bugs(result, tracker)
+        finally:
+            for client in clients:
+                client.close()
+
+    run_coroutine(run_searches())
+
+    if failed:
+        raise BugzError('Search failed on: %s' % ', '.join(failed))
+
+
+def search_local(settings):
+    """Search the local full-text index instead of the server."""
+    if not hasattr(settings, 'terms'):
+        raise BugzError('Please give search terms for a local search.')
+    query = ' '.join(settings.terms)
+    log_info('Searching the local index for: %s' % query)
+
+    db = open_index(settings)
+    result = search_index(db, query, getattr(settings, 'limit', None))
+    db.close()
 
     if not len(result):
         log_info('No bugs found.')
@@ -668,6 +1566,695 @@ the keywords given on the title (or the body if specified).
         list_bugs(result, settings)
 
 
+def sync(settings):
+    """Add the bugs matching a search, with comments, to the local index."""
+    params = search_params(settings)
+
+    check_auth(settings)
+
+    log_info('Searching for bugs to index ..')
+    buglist = search_bugs(settings, params)
+
+    db = open_index(settings)
+    for start in range(0, len(buglist), SYNC_BATCH_SIZE):
+        batch = buglist[start:start + SYNC_BATCH_SIZE]
+        params = {'ids': [bug['id'] for bug in batch]}
+        result = settings.call_bz(settings.bz.Bug.comments, params)
+        comments = {}
+        for bug in batch:
+            comments[bug['id']] = result['bugs']['%s' % bug['id']]['comments']
+        index_bugs(db, batch, comments)
+        log_info('Indexed %d of %d bugs' % (start + len(batch), len(buglist)))
+    db.close()
+
+
+def export(settings):
+    """Export the bugs matching a search, with their comments, history
+    and attachments, to an archive.
+
+    The bugs are fetched --batch-size at a time, with the calls for a
+    batch made concurrently.  Running an interrupted export again
+    continues it.
+    """
+    params = search_params(settings)
+
+    check_auth(settings)
+
+    writer = ArchiveWriter(settings.out, settings.connection,
+                           settings.safe_base, params)
+    ids = writer.manifest['ids']
+    if ids is None:
+        log_info('Searching for bugs to export ..')
+        result = search_bugs(settings, dict(params, include_fields=['id']))
+        ids = sorted(bug['id'] for bug in result)
+        writer.set_ids(ids)
+
+    done = writer.done_ids()
+    todo = [x for x in ids if x not in done]
+    if done:
+        log_info('Resuming export, %d of %d bugs done' %
+                 (len(ids) - len(todo), len(ids)))
+
+    run_coroutine(export_bugs(settings, writer, todo))
+    writer.finish()
+
+
+async def export_bugs(settings, writer, todo):
+    """Fetch the bugs to export a batch at a time and write them to the
+    archive, over one set of kept alive connections.
+    """
+    ids = writer.manifest['ids']
+    client = AsyncBugzilla(settings, settings.max_connections)
+    try:
+        for start in range(0, len(todo), settings.batch_size):
+            batch = todo[start:start + settings.batch_size]
+            bugs, comments, history, attachments = await client.call_many([
+                ('Bug.get', {'ids': batch}),
+                ('Bug.comments', {'ids': batch}),
+                ('Bug.history', {'ids': batch}),
+                ('Bug.attachments', {'ids': batch,
+                                     'exclude_fields': ['data']}),
+            ])
+
+            history = dict(('%s' % bug['id'], bug['history'])
+                           for bug in history['bugs'])
+            records = []
+            for bug in bugs['bugs']:
+                bugid = '%s' % bug['id']
+                records.append({
+                    'bug': bug,
+                    'comments': comments['bugs'][bugid]['comments'],
+                    'history': history.get(bugid, []),
+                    'attachments': attachments['bugs'].get(bugid, []),
+                })
+
+            if not hasattr(settings, 'no_attachments'):
+                await export_attachments(settings, client, writer, records)
+
+            writer.add_shard(records)
+            log_info('Exported %d of %d bugs' %
+                     (len(ids) - len(todo) + start + len(batch), len(ids)))
+    finally:
+        client.close()
+
+
+async def export_attachments(settings, client, writer, records):
+    """Download the attachments of some bugs into the archive, at most
+    max_connections at a time.
+    """
+    pending = [x for record in records for x in record['attachments']]
+    step = settings.max_connections
+    for start in range(0, len(pending), step):
+        group = pending[start:start + step]
+        results = await client.call_many([
+            ('Bug.attachments', {'attachment_ids': [x['id']]})
+            for x in group])
+        for attachment, result in zip(group, results):
+            data = result['attachments']['%s' % attachment['id']]['data']
+            attachment['sha256'] = writer.add_attachment(data.data)
+
+
+def report(settings):
+    """Count the bugs matching a search, grouped by some of their fields.
+
+    Only the grouping fields are requested, a page of --page-size bugs at
+    a time, and each page is counted and dropped before the next one is
+    fetched.  Without --group-by, the server only counts the bugs.
+    """
+    params = search_params(settings)
+    fields = getattr(settings, 'group_by', [])
+
+    check_auth(settings)
+
+    if not fields:
+        # servers before Bugzilla 5.0 ignore count_only and return the
+        # bugs, so only their ids are asked for
+        result = settings.call_bz(settings.bz.Bug.search,
+                                  dict(params, count_only=True,
+                                       include_fields=['id']))
+        if 'bug_count' in result:
+            print(result['bug_count'])
+        else:
+            print(len(result['bugs']))
+        return
+
+    counts = collections.Counter()
+    capped = cap_search(settings, params)
+    limit = params.pop('limit', None)
+    offset = params.pop('offset', 0)
+    params['include_fields'] = ['id'] + fields
+    total = 0
+    while limit is None or total < limit:
+        page = settings.page_size
+        if limit is not None:
+            page = min(page, limit - total)
+        result = settings.call_bz(settings.bz.Bug.search,
+                                  dict(params, limit=page,
+                                       offset=offset + total))['bugs']
+        for bug in result:
+            key = []
+            for field in fields:
+                value = bug.get(field, '')
+                if isinstance(value, list):
+                    value = ','.join('%s' % x for x in value)
+                key.append('%s' % value)
+            counts[tuple(key)] += 1
+        # the server may return fewer bugs than asked for, eg. when
+        # its max_search_results is lower, so only an empty page ends
+        if not result:
+            break
+        total += len(result)
+        log_debug('Counted %d bugs' % total)
+    if capped:
+        check_search_results(settings, total)
+
+    if settings.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fields + ['count'])
+        for key in sorted(counts):
+            writer.writerow(list(key) + [counts[key]])
+    elif len(fields) == 2:
+        print_pivot_table(counts, fields)
+    else:
+        width = [max([len(field)] + [len(key[i]) for key in counts])
+                 for i, field in enumerate(fields)]
+        print(' '.join(field.ljust(w) for field, w in zip(fields, width)) +
+              ' count')
+        for key in sorted(counts):
+            print(' '.join(x.ljust(w) for x, w in zip(key, width)) +
+                  ' %5d' % counts[key])
+    log_info('%d bug(s) counted.' % total)
+
+
+def print_pivot_table(counts, fields):
+    rows = sorted(set(key[0] for key in counts))
+    columns = sorted(set(key[1] for key in counts))
+    first = max([len(fields[0])] + [len(x) for x in rows] + [len('total')])
+    width = [max(len(x), 5) for x in columns]
+
+    print('%s %s total' % (fields[0].ljust(first),
+                           ' '.join(x.rjust(w) for x, w in zip(columns,
+                                                                 width))))
+    for row in rows:
+        cells = [counts[(row, x)] for x in columns]
+        print('%s %s %5d' % (row.ljust(first),
+                             ' '.join(('%d' % x).rjust(w)
+                                      for x, w in zip(cells, width)),
+                             sum(cells)))
+    cells = [sum(counts[(row, x)] for row in rows) for x in columns]
+    print('%s %s %5d' % ('total'.ljust(first),
+                         ' '.join(('%d' % x).rjust(w)
+                                  for x, w in zip(cells, width)),
+                         sum(cells)))
+
+
+def browse(settings):
+    """Search for bugs and open them one at a time.
+
+    While a bug is being read, the attachments and comments of its
+    neighbours in the result list are fetched in the background, so
+    moving to the next or previous bug does not wait for the server.
+    """
+    params = search_params(settings)
+
+    check_auth(settings)
+
+    buglist = search_bugs(settings, params)
+    if not len(buglist):
+        log_info('No bugs found.')
+        return
+
+    ids = [bug['id'] for bug in buglist]
+    bugs = dict(zip(ids, buglist))
+    pending = {}
+
+    # The prefetch thread has its own proxy; proxies are not thread safe.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    prefetch_bz = settings.make_proxy()
+
+    def prefetch(row):
+        first = max(row - settings.prefetch, 0)
+        last = min(row + settings.prefetch, len(ids) - 1)
+        wanted = [x for x in ids[first:last + 1] if x not in pending]
+        if wanted:
+            future = executor.submit(fetch_bug_details, settings,
+                                     prefetch_bz, wanted)
+            for bugid in wanted:
+                pending[bugid] = future
+
+    def details(bugid):
+        try:
+            return pending[bugid].result()[bugid]
+        except (KeyError, BugzError):
+            result = fetch_bug_details(settings, settings.bz, [bugid])
+            pending[bugid] = concurrent.futures.Future()
+            pending[bugid].set_result(result)
+            return result[bugid]
+
+    list_bugs(buglist, settings)
+    prefetch(0)
+    row = None
+    try:
+        while True:
+            try:
+                choice = input('Bug id, [n]ext, [p]revious, [l]ist '
+                               'or [q]uit: ').strip()
+            except EOFError:
+                print()
+                break
+            if choice in ['q', 'quit']:
+                break
+            elif choice in ['l', 'list']:
+                list_bugs(buglist, settings)
+                continue
+            elif choice in ['n', 'next', '']:
+                row = 0 if row is None else min(row + 1, len(ids) - 1)
+            elif choice in ['p', 'previous']:
+                row = 0 if row is None else max(row - 1, 0)
+            elif choice.isdigit() and int(choice) in bugs:
+                row = ids.index(int(choice))
+            else:
+                log_error('Not a bug in this list: %s' % choice)
+                continue
+            prefetch(row)
+            bugid = ids[row]
+            show_bug_info(bugs[bugid], settings, details(bugid))
+            remember_bugs(settings, [bugs[bugid]])
+    finally:
+        executor.shutdown(wait=False)
+
+
+def watch(settings):
+    """Poll a search and report only the bugs that changed.
+
+    Each poll adds the server time of the previous one as
+    last_change_time to the search, so unchanged bugs are not sent
+    again.  While nothing changes, the interval between polls doubles
+    up to --max-interval.
+    """
+    params = search_params(settings)
+
+    check_auth(settings)
+
+    since = settings.call_bz(settings.bz.Bugzilla.time, {})['db_time']
+    log_info('Watching for changes every %d seconds ..' % settings.interval)
+    reported = set()
+    interval = settings.interval
+    while True:
+        time.sleep(interval)
+        now = settings.call_bz(settings.bz.Bugzilla.time, {})['db_time']
+        params['last_change_time'] = since
+        buglist = search_bugs(settings, params)
+        since = now
+
+        # a bug changed during the previous poll is found by both polls
+        changes = set(('%s' % bug['id'], '%s' % bug['last_change_time'])
+                      for bug in buglist)
+        buglist = [bug for bug in buglist if
+                   ('%s' % bug['id'], '%s' % bug['last_change_time'])
+                   not in reported]
+        reported = changes
+
+        if not buglist:
+            interval = min(interval * 2, settings.max_interval)
+            log_debug('No changes, next poll in %d seconds' % interval)
+            continue
+        interval = settings.interval
+
+        if settings.format == 'jsonl':
+            for bug in buglist:
+                print(json.dumps(bug, default=json_default, sort_keys=True))
+        else:
+            list_bugs(buglist, settings)
+        sys.stdout.flush()
+
+        if hasattr(settings, 'exec_command'):
+            # the output of the command would break up the json lines
+            stdout = sys.stderr if settings.format == 'jsonl' else None
+            for bug in buglist:
+                env = dict(os.environ, BUGZ_BUG_ID='%s' % bug['id'])
+                subprocess.run(settings.exec_command, shell=True, env=env,
+                               input=json.dumps(bug, default=str),
+                               stdout=stdout, universal_newlines=True)
+
+
+def query_save(settings):
+    """Save search options as a named query."""
+    params = search_params(settings)
+    if hasattr(settings, 'incremental') and \
+            ('limit' in params or 'offset' in params):
+        raise BugzError('--limit and --offset cannot be used with '
+                        '--incremental')
+
+    queries = load_queries()
+    name = settings.query_name
+    if queries.has_section(name):
+        queries.remove_section(name)
+    queries.add_section(name)
+    for key in sorted(params):
+        queries.set(name, key, json.dumps(params[key]))
+    if hasattr(settings.args, 'connection'):
+        queries.set(name, QUERY_CONNECTION, settings.connection)
+    for key in QUERY_OPTIONS:
+        if hasattr(settings, key):
+            queries.set(name, key, json.dumps(getattr(settings, key)))
+    save_queries(queries)
+    log_info('Saved query %s' % name)
+
+
+def query_list(settings):
+    queries = load_queries()
+    for name in queries.sections():
+        print(name)
+        for key, value in queries.items(name):
+            print('   {0:<20} = {1}'.format(key, value))
+
+
+def query_delete(settings):
+    queries = load_queries()
+    if not queries.remove_section(settings.query_name):
+        raise BugzError('No saved query named %s' % settings.query_name)
+    save_queries(queries)
+    log_info('Deleted query %s' % settings.query_name)
+
+
+def query_run(settings):
+    """Run a saved query.
+
+    Values of the form {name} in the saved parameters are replaced with
+    the values given with --param name=value.
+
+    A query saved with --cache-ttl keeps its results for that many
+    seconds.  A query saved with --incremental keeps its results and
+    on later runs asks the server only for the bugs changed since then.
+    """
+    queries = load_queries()
+    name = settings.query_name
+    if not queries.has_section(name):
+        raise BugzError('No saved query named %s' % name)
+
+    values = {}
+    for param in getattr(settings, 'query_params', []):
+        key, sep, value = param.partition('=')
+        if not sep:
+            raise BugzError('--param needs the form name=value: %s' % param)
+        values[key] = value
+
+    def substitute(value):
+        if isinstance(value, list):
+            return [substitute(x) for x in value]
+        if not isinstance(value, str):
+            return value
+        try:
+            return value.format_map(values)
+        except KeyError as error:
+            raise BugzError('Query %s needs a value for {%s}, '
+                            'use --param %s=VALUE' %
+                            (name, error.args[0], error.args[0]))
+
+    params = {}
+    options = {}
+    for key, value in queries.items(name):
+        if key == QUERY_CONNECTION:
+            continue
+        elif key in QUERY_OPTIONS:
+            options[key] = json.loads(value)
+        else:
+            params[key] = substitute(json.loads(value))
+
+    if queries.has_option(name, QUERY_CONNECTION) and \
+            not hasattr(settings.args, 'connection'):
+        connection = queries.get(name, QUERY_CONNECTION)
+        if connection != settings.connection:
+            settings = settings.for_connection(connection)
+    for key in ['show_status', 'show_priority', 'show_severity']:
+        if options.get(key):
+            setattr(settings, key, True)
+
+    log_info('Running query %s' % name)
+    for key in params:
+        log_info('   {0:<20} = {1}'.format(key, params[key]))
+
+    check_auth(settings)
+
+    # the results of a query saved again with other options are not used
+    key = json.dumps([name, params, options], sort_keys=True)
+    path = os.path.join(cache_dir('query', safe_name(settings.connection)),
+                        '%s.json' % hashlib.sha256(key.encode()).hexdigest())
+    state = None if hasattr(settings, 'refresh') else load_json(path)
+    ttl = options.get('cache_ttl', 0)
+
+    if state is not None and time.time() - state['time'] < ttl:
+        log_info('Using cached query results')
+        CACHE_HITS.inc(cache='query')
+        result = state['bugs']
+    elif options.get('incremental'):
+        CACHE_MISSES.inc(cache='query')
+        now = settings.call_bz(settings.bz.Bugzilla.time, {})['db_time']
+        if state is None or state['since'] is None:
+            result = search_bugs(settings, params)
+        else:
+            result = refresh_results(settings, params, state['bugs'],
+                                     xmlrpc.client.DateTime(state['since']))
+        save_json(path, {'time': time.time(), 'since': now, 'bugs': result})
+    else:
+        if ttl:
+            CACHE_MISSES.inc(cache='query')
+        result = search_bugs(settings, params)
+        if ttl:
+            save_json(path, {'time': time.time(), 'since': None,
+                             'bugs': result})
+
+    if not len(result):
+        log_info('No bugs found.')
+    else:
+        list_bugs(result, settings)
+
+
+def refresh_results(settings, params, buglist, since):
+    """Bring the results of an earlier search up to date.
+
+    Only two small searches are needed: the ids of the known bugs which
+    changed since then, and the bugs matching the search which changed
+    since then.  Known bugs which changed but no longer match drop out.
+    """
+    changed = set()
+    # an empty id list could be taken as no restriction at all
+    if buglist:
+        known = settings.call_bz(settings.bz.Bug.search,
+                                 {'id': [bug['id'] for bug in buglist],
+                                  'last_change_time': since,
+                                  'include_fields': ['id']})['bugs']
+        changed.update(bug['id'] for bug in known)
+    fresh = settings.call_bz(settings.bz.Bug.search,
+                             dict(params, last_change_time=since))['bugs']
+    changed.update(bug['id'] for bug in fresh)
+    log_info('%d bug(s) changed since the last run' % len(changed))
+
+    result = [bug for bug in buglist if bug['id'] not in changed] + fresh
+    result.sort(key=lambda bug: bug['id'])
+    return result
+
+
+def batch(settings):
+    """Run the commands read from a file, one per line.
+
+    A line is either a command line without the program name, such as
+    "modify 123 -c 'Fixed in 1.2'", or a JSON list of its words.  Lines
+    are read BATCH_WINDOW at a time.  Consecutive modify lines making the
+    same changes to different bugs are sent as one Bug.update, and up to
+    --jobs updates run at the same time on the connections of one asyncio
+    client, kept open for the whole file.  Bugs given by alias or as 05
+    are resolved to their numbers first, so updates of the same bug are
+    never run at the same time.  Other commands run one after the other.
+    One JSON result line is printed per command, in the order they were
+    read, and log messages go to stderr.
+    """
+    parser = make_arg_parser()
+    client = AsyncBugzilla(settings, settings.jobs)
+    loop = asyncio.new_event_loop()
+
+    async def update(group, numbers):
+        ids = [bugid for _, args, _ in group for bugid in args.bugid]
+        try:
+            result = await client.call('Bug.update',
+                                       dict(group[0][2], ids=ids))
+        except BugzError as error:
+            if len(group) == 1:
+                return [batch_error(group[0][0], error)]
+            # find out which of the commands failed
+            results = []
+            for line in group:
+                results.extend(await update([line], numbers))
+            return results
+        results = []
+        for number, args, _ in group:
+            names = set(numbers[x] for x in args.bugid)
+            bugs = [x for x in result['bugs'] if '%s' % x['id'] in names]
+            results.append({'line': number, 'ok': True, 'bugs': bugs})
+        return results
+
+    async def update_all(groups, numbers):
+        results = await asyncio.gather(*[update(group, numbers)
+                                         for group in groups])
+        return [x for group in results for x in group]
+
+    def bug_numbers(lines):
+        """Map the bug ids of the modify lines to the bug numbers, with
+        one Bug.get for the aliases.
+        """
+        numbers = {}
+        for _, args in lines:
+            if batch_groupable(args):
+                for bugid in args.bugid:
+                    numbers[bugid] = normalize_bugid(bugid)
+        aliases = [x for x in numbers if not numbers[x].isdigit()]
+        if aliases:
+            try:
+                bugs = loop.run_until_complete(client.call('Bug.get', {
+                    'ids': aliases,
+                    'include_fields': ['id', 'alias'],
+                    'permissive': True,
+                }))['bugs']
+            except BugzError as error:
+                log_debug('unable to look up aliases: %s' % error)
+                bugs = []
+            found = bug_names(bugs)
+            for bugid in aliases:
+                if bugid in found:
+                    numbers[bugid] = '%s' % found[bugid]['id']
+        return numbers
+
+    def run_window(window):
+        results = []
+        lines = []
+        for number, line in window:
+            try:
+                lines.append((number, parse_batch_line(parser, line)))
+            except BugzError as error:
+                results.append(batch_error(number, error))
+        numbers = bug_numbers(lines)
+
+        groups = collections.OrderedDict()
+        touched = set()
+
+        def flush():
+            results.extend(loop.run_until_complete(
+                update_all(list(groups.values()), numbers)))
+            groups.clear()
+            touched.clear()
+
+        for number, args in lines:
+            try:
+                if not batch_groupable(args):
+                    flush()
+                    results.append(run_batch_command(settings, number, args))
+                    continue
+                params = modify_params(args)
+                if not params:
+                    raise BugzError('No changes were specified')
+            except BugzError as error:
+                results.append(batch_error(number, error))
+                continue
+
+            # updates of the same bugs must not be merged or reordered
+            bugs = set(numbers[x] for x in args.bugid)
+            if touched.intersection(bugs):
+                flush()
+            touched.update(bugs)
+            key = json.dumps(params, sort_keys=True, default=json_default)
+            groups.setdefault(key, []).append((number, args, params))
+        flush()
+
+        for result in sorted(results, key=lambda x: x['line']):
+            print(json.dumps(result, default=json_default))
+        sys.stdout.flush()
+
+    if settings.file == '-':
+        fd = sys.stdin
+    else:
+        try:
+            fd = open(settings.file)
+        except OSError as error:
+            raise BugzError('unable to read file: %s' % error)
+
+    check_auth(settings)
+
+    try:
+        window = []
+        for number, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            window.append((number, line))
+            if len(window) >= BATCH_WINDOW:
+                run_window(window)
+                window = []
+        if window:
+            run_window(window)
+    finally:
+        client.close()
+        loop.close()
+
+
+def parse_batch_line(parser, line):
+    """Parse a line of bugz batch into the arguments of a command."""
+    try:
+        if line.startswith('['):
+            words = json.loads(line)
+        else:
+            words = shlex.split(line)
+    except ValueError as error:
+        raise BugzError('invalid line: %s' % error)
+
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), \
+                contextlib.redirect_stderr(output):
+            args = parser.parse_args(['%s' % x for x in words])
+    except SystemExit:
+        message = output.getvalue().strip().splitlines()
+        raise BugzError(message[-1] if message else 'invalid command')
+
+    if not hasattr(args, 'func') or args.func is batch:
+        raise BugzError('invalid command: %s' % line)
+    return args
+
+
+def batch_groupable(args):
+    """Tell whether a command of bugz batch is a plain modify, which can
+    be merged with others.
+    """
+    if args.func is not modify:
+        return False
+    return not any(hasattr(args, x) for x in BATCH_SEPARATE_OPTIONS)
+
+
+def run_batch_command(settings, number, args):
+    """Run a command of bugz batch on its own, capturing its output."""
+    line_args = argparse.Namespace(**vars(settings.args))
+    for key, value in vars(args).items():
+        setattr(line_args, key, value)
+
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            line_settings = Settings(line_args, settings.config)
+            if line_settings.connection == settings.connection and \
+                    hasattr(settings, 'token'):
+                line_settings.token = settings.token
+            args.func(line_settings)
+    except (BugzError, RuntimeError) as error:
+        return batch_error(number, error)
+    except SystemExit:
+        return batch_error(number, output.getvalue().strip())
+    return {'line': number, 'ok': True, 'output': output.getvalue()}
+
+
+def batch_error(number, error):
+    return {'line': number, 'ok': False, 'error': '%s' % error}
+
+
 def connections(settings):
     print('Known bug trackers:')
     print()
@@ -681,9 +2268,18 @@ def main():
 
     ConfigParser = load_config(getattr(args, 'config_file', None))
 
+    # keep the log messages out of output meant for other programs
+    if getattr(args, 'format', None) in MACHINE_FORMATS or \
+            getattr(args, 'func', None) is batch:
+        log_setOutput(sys.stderr)
+
     check_bugz_token()
     settings = Settings(args, ConfigParser)
 
+    if hasattr(settings, 'metrics_file'):
+        export_metrics(settings.metrics_file, settings.metrics_interval,
+                       settings.metrics_format == 'openmetrics')
+
     if not hasattr(args, 'func'):
         ArgParser.print_usage()
         return 1
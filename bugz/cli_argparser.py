@@ -5,6 +5,73 @@ import bugz.cli
 from bugz import __version__
 
 
+def comma_list(value):
+    return [x.strip() for x in value.split(',')]
+
+
+def add_search_arguments(parser):
+    """Add the options shared by the commands that run a search."""
+    parser.add_argument('terms',
+                        nargs='*',
+                        help='strings to search for in '
+                        'the title and/or body')
+    parser.add_argument('--alias',
+                        help='The unique alias for this bug')
+    parser.add_argument('-a', '--assigned-to',
+                        help='email the bug is assigned to')
+    parser.add_argument('--cc',
+                        help='email in the CC list for the bug')
+    parser.add_argument('-C', '--component',
+                        action='append',
+                        help='restrict by component (1 or more)')
+    parser.add_argument('-r', '--creator',
+                        help='email of the person who created the bug')
+    parser.add_argument('-l', '--limit',
+                        type=int,
+                        help='Limit the number of records '
+                        'returned by a search')
+    parser.add_argument('--offset',
+                        type=int,
+                        help='Set the start position for a search')
+    parser.add_argument('--op-sys',
+                        action='append',
+                        help='restrict by Operating System '
+                        '(one or more)')
+    parser.add_argument('--platform',
+                        action='append',
+                        help='restrict by platform (one or more)')
+    parser.add_argument('--priority',
+                        action='append',
+                        help='restrict by priority (one or more)')
+    parser.add_argument('--product',
+                        action='append',
+                        help='restrict by product (one or more)')
+    parser.add_argument('--resolution',
+                        help='restrict by resolution')
+    parser.add_argument('--severity',
+                        action='append',
+                        help='restrict by severity (one or more)')
+    parser.add_argument('-s', '--status',
+                        action='append',
+                        dest='search_statuses',
+                        help='restrict by status '
+                        '(one or more, use all for all statuses)')
+    parser.add_argument('-v', '--version',
+                        action='append',
+                        help='restrict by version (one or more)')
+    parser.add_argument('-w', '--whiteboard',
+                        help='status whiteboard')
+    parser.add_argument('--show-status',
+                        action='store_true',
+                        help='show status of bugs')
+    parser.add_argument('--show-priority',
+                        action='store_true',
+                        help='show priority of bugs')
+    parser.add_argument('--show-severity',
+                        action='store_true',
+                        help='show severity of bugs')
+
+
 def make_arg_parser():
     parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
     parser.add_argument('--config-file',
@@ -39,6 +106,9 @@ def make_arg_parser():
     parser.add_argument('--insecure',
                         action='store_true',
                         help='do not verify ssl certificate')
+    parser.add_argument('--metrics-file',
+                        help='write metrics in the Prometheus text format '
+                        'to this file when exiting')
     parser.add_argument('--interactive',
                         action='store_true',
                         help='prompt for username and password if '
@@ -74,6 +144,11 @@ def make_arg_parser():
                                dest='summary',
                                help='a short description of the '
                                'attachment (default: filename).')
+    attach_parser.add_argument('--force',
+                               action='store_true',
+                               help='attach the file even if the bug '
+                               'already has an attachment with the same '
+                               'content')
     attach_parser.set_defaults(func=bugz.cli.attach)
 
     attachment_parser = subparsers.add_parser('attachment',
@@ -85,12 +160,82 @@ def make_arg_parser():
     attachment_parser.add_argument('-v', '--view',
                                    action="store_true",
                                    help='print attachment rather than save')
+    attachment_parser.add_argument('--head',
+                                   type=int,
+                                   metavar='N',
+                                   help='print the first N lines of the '
+                                   'attachment')
+    attachment_parser.add_argument('--tail',
+                                   type=int,
+                                   metavar='N',
+                                   help='print the last N lines of the '
+                                   'attachment')
+    attachment_parser.add_argument('--grep',
+                                   metavar='PATTERN',
+                                   help='print the numbered lines of the '
+                                   'attachment matching PATTERN')
     attachment_parser.set_defaults(func=bugz.cli.attachment)
 
+    batch_parser = subparsers.add_parser('batch',
+                                         argument_default=argparse.SUPPRESS,
+                                         help='run the commands read from '
+                                         'a file, one per line')
+    batch_parser.add_argument('file',
+                              help='the file to read, or - for standard '
+                              'input')
+    batch_parser.add_argument('-j', '--jobs',
+                              type=int,
+                              default=4,
+                              help='number of updates to run at the same '
+                              'time (default: 4)')
+    batch_parser.set_defaults(func=bugz.cli.batch)
+
+    browse_parser = subparsers.add_parser('browse',
+                                          argument_default=argparse.SUPPRESS,
+                                          help='search for bugs and open '
+                                          'them interactively')
+    add_search_arguments(browse_parser)
+    browse_parser.add_argument('--prefetch',
+                               type=int,
+                               default=2,
+                               help='number of neighbouring bugs to fetch '
+                               'in the background (default: 2)')
+    browse_parser.add_argument("--no-attachments",
+                               action="store_true",
+                               help='do not show attachments')
+    browse_parser.add_argument("--no-comments",
+                               action="store_true",
+                               help='do not show comments')
+    browse_parser.set_defaults(func=bugz.cli.browse)
+
     connections_parser = subparsers.add_parser('connections',
                                                help='list known bug trackers')
     connections_parser.set_defaults(func=bugz.cli.connections)
 
+    export_parser = subparsers.add_parser('export',
+                                          argument_default=argparse.SUPPRESS,
+                                          help='export the bugs matching '
+                                          'a search to an archive')
+    add_search_arguments(export_parser)
+    export_parser.add_argument('--out',
+                               required=True,
+                               help='directory of the archive; an '
+                               'interrupted export is resumed')
+    export_parser.add_argument('--batch-size',
+                               type=int,
+                               default=100,
+                               help='number of bugs to fetch per request '
+                               '(default: 100)')
+    export_parser.add_argument('--max-connections',
+                               type=int,
+                               default=4,
+                               help='number of requests to run at the '
+                               'same time (default: 4)')
+    export_parser.add_argument('--no-attachments',
+                               action='store_true',
+                               help='do not download the attachment data')
+    export_parser.set_defaults(func=bugz.cli.export)
+
     get_parser = subparsers.add_parser('get',
                                        argument_default=argparse.SUPPRESS,
                                        help='get a bug from bugzilla')
@@ -104,12 +249,40 @@ def make_arg_parser():
                             help='do not show comments')
     get_parser.set_defaults(func=bugz.cli.get)
 
+    grep_parser = subparsers.add_parser('grep',
+                                        argument_default=argparse.SUPPRESS,
+                                        help='search the comments of bugs')
+    grep_parser.add_argument('pattern',
+                             help='the regular expression to look for')
+    grep_parser.add_argument('bugid',
+                             nargs='+',
+                             help='the IDs of the bugs')
+    grep_parser.add_argument('-i', '--ignore-case',
+                             action='store_true',
+                             help='ignore case when matching')
+    grep_parser.set_defaults(func=bugz.cli.grep)
+
+    history_parser = subparsers.add_parser('history',
+                                           argument_default=argparse.SUPPRESS,
+                                           help='show the change history '
+                                           'of bugs')
+    history_parser.add_argument('bugid',
+                                nargs='+',
+                                help='the IDs of the bugs')
+    history_parser.add_argument('--format',
+                                choices=['text', 'jsonl'],
+                                default='text',
+                                help='output format; jsonl prints one '
+                                'change per line (default: text)')
+    history_parser.set_defaults(func=bugz.cli.history)
+
     modify_parser = subparsers.add_parser('modify',
                                           argument_default=argparse.SUPPRESS,
                                           help='modify a bug '
                                           '(eg. post a comment)')
     modify_parser.add_argument('bugid',
-                               help='the ID of the bug to modify')
+                               nargs='+',
+                               help='the IDs of the bugs to modify')
     modify_parser.add_argument('--alias',
                                help='change the alias for this bug')
     modify_parser.add_argument('-a', '--assigned-to',
@@ -218,6 +391,29 @@ def make_arg_parser():
                                help='set the version for this bug')
     modify_parser.add_argument('-w', '--whiteboard',
                                help='set Status whiteboard')
+    modify_parser.add_argument('--if-unchanged-since',
+                               metavar='TIMESTAMP',
+                               help='only modify the bugs which were not '
+                               'changed after TIMESTAMP (UTC)')
+    modify_parser.add_argument('--expect-from',
+                               metavar='FILE',
+                               help='only modify the bugs which were not '
+                               'changed after the time given for them in '
+                               'FILE, with lines of "ID TIMESTAMP" or JSON '
+                               'bugs holding id and last_change_time')
+    modify_parser.add_argument('--journal',
+                               metavar='FILE',
+                               help='record the bugs modified so far in '
+                               'FILE, so the run can be resumed')
+    modify_parser.add_argument('--resume',
+                               metavar='FILE',
+                               help='continue the run recorded in FILE '
+                               'with the same arguments, skipping the bugs '
+                               'already modified')
+    modify_parser.add_argument('--skip-unchanged',
+                               action='store_true',
+                               help='fetch the current values first and only '
+                               'send the changes the bugs do not have yet')
     modify_parser.add_argument('--fixed',
                                action='store_true',
                                help='mark bug as RESOLVED, FIXED')
@@ -269,68 +465,167 @@ def make_arg_parser():
                              help='default answer to confirmation question')
     post_parser.set_defaults(func=bugz.cli.post)
 
+    query_parser = subparsers.add_parser('query',
+                                         help='save and run named searches')
+    query_subparsers = query_parser.add_subparsers(title='query commands')
+
+    query_delete_parser = query_subparsers.add_parser(
+        'delete',
+        argument_default=argparse.SUPPRESS,
+        help='delete a saved query')
+    query_delete_parser.add_argument('query_name',
+                                     metavar='name',
+                                     help='the name of the query')
+    query_delete_parser.set_defaults(func=bugz.cli.query_delete)
+
+    query_list_parser = query_subparsers.add_parser('list',
+                                                    help='list saved queries')
+    query_list_parser.set_defaults(func=bugz.cli.query_list)
+
+    query_run_parser = query_subparsers.add_parser(
+        'run',
+        argument_default=argparse.SUPPRESS,
+        help='run a saved query')
+    query_run_parser.add_argument('query_name',
+                                  metavar='name',
+                                  help='the name of the query')
+    query_run_parser.add_argument('--param',
+                                  action='append',
+                                  dest='query_params',
+                                  help='value for a {name} in the query, '
+                                  'given as name=value')
+    query_run_parser.add_argument('--refresh',
+                                  action='store_true',
+                                  help='ignore cached results')
+    query_run_parser.add_argument('--show-status',
+                                  action='store_true',
+                                  help='show status of bugs')
+    query_run_parser.add_argument('--show-priority',
+                                  action='store_true',
+                                  help='show priority of bugs')
+    query_run_parser.add_argument('--show-severity',
+                                  action='store_true',
+                                  help='show severity of bugs')
+    query_run_parser.set_defaults(func=bugz.cli.query_run)
+
+    query_save_parser = query_subparsers.add_parser(
+        'save',
+        argument_default=argparse.SUPPRESS,
+        help='save search options as a query; values may contain '
+        '{name} to be filled in by query run --param')
+    query_save_parser.add_argument('query_name',
+                                   metavar='name',
+                                   help='the name of the query')
+    add_search_arguments(query_save_parser)
+    query_save_parser.add_argument('--cache-ttl',
+                                   type=int,
+                                   help='keep the results of this query '
+                                   'for this many seconds')
+    query_save_parser.add_argument('--incremental',
+                                   action='store_true',
+                                   help='keep the results of this query and '
+                                   'only fetch the changed bugs when it is '
+                                   'run again')
+    query_save_parser.set_defaults(func=bugz.cli.query_save)
+
+    report_parser = subparsers.add_parser('report',
+                                          argument_default=argparse.SUPPRESS,
+                                          help='count the bugs matching '
+                                          'a search')
+    add_search_arguments(report_parser)
+    report_parser.add_argument('--group-by',
+                               type=comma_list,
+                               help='comma separated list of the fields '
+                               'to count the bugs by, e.g. component,status')
+    report_parser.add_argument('--format',
+                               choices=['table', 'csv'],
+                               default='table',
+                               help='output format (default: table)')
+    report_parser.add_argument('--page-size',
+                               type=int,
+                               default=1000,
+                               help='number of bugs to fetch per request '
+                               '(default: 1000)')
+    report_parser.set_defaults(func=bugz.cli.report)
+
     search_parser = subparsers.add_parser('search',
                                           argument_default=argparse.SUPPRESS,
                                           help='search for bugs in bugzilla')
-    search_parser.add_argument('terms',
-                               nargs='*',
-                               help='strings to search for in '
-                               'the title and/or body')
-    search_parser.add_argument('--alias',
-                               help='The unique alias for this bug')
-    search_parser.add_argument('-a', '--assigned-to',
-                               help='email the bug is assigned to')
-    search_parser.add_argument('--cc',
-                               help='email in the CC list for the bug')
-    search_parser.add_argument('-C', '--component',
-                               action='append',
-                               help='restrict by component (1 or more)')
-    search_parser.add_argument('-r', '--creator',
-                               help='email of the person who created the bug')
-    search_parser.add_argument('-l', '--limit',
-                               type=int,
-                               help='Limit the number of records '
-                               'returned by a search')
-    search_parser.add_argument('--offset',
-                               type=int,
-                               help='Set the start position for a search')
-    search_parser.add_argument('--op-sys',
-                               action='append',
-                               help='restrict by Operating System '
-                               '(one or more)')
-    search_parser.add_argument('--platform',
-                               action='append',
-                               help='restrict by platform (one or more)')
-    search_parser.add_argument('--priority',
-                               action='append',
-                               help='restrict by priority (one or more)')
-    search_parser.add_argument('--product',
-                               action='append',
-                               help='restrict by product (one or more)')
-    search_parser.add_argument('--resolution',
-                               help='restrict by resolution')
-    search_parser.add_argument('--severity',
-                               action='append',
-                               help='restrict by severity (one or more)')
-    search_parser.add_argument('-s', '--status',
-                               action='append',
-                               dest='search_statuses',
-                               help='restrict by status '
-                               '(one or more, use all for all statuses)')
-    search_parser.add_argument('-v', '--version',
-                               action='append',
-                               help='restrict by version (one or more)')
-    search_parser.add_argument('-w', '--whiteboard',
-                               help='status whiteboard')
-    search_parser.add_argument('--show-status',
+    add_search_arguments(search_parser)
+    search_parser.add_argument('--connections',
+                               dest='search_connections',
+                               type=comma_list,
+                               help='search the connections in this comma '
+                               'separated list at the same time')
+    search_parser.add_argument('--compact',
+                               action='store_true',
+                               help='only fetch and keep the fields which '
+                               'are listed, to save memory on large searches')
+    search_parser.add_argument('--no-cache',
                                action='store_true',
-                               help='show status of bugs')
-    search_parser.add_argument('--show-priority',
+                               help='neither use nor update the search cache')
+    search_parser.add_argument('--refresh',
                                action='store_true',
-                               help='show priority of bugs')
-    search_parser.add_argument('--show-severity',
+                               help='ignore cached results, but cache the '
+                               'new ones')
+    search_parser.add_argument('--local',
                                action='store_true',
-                               help='show severity of bugs')
+                               help='search the terms in the local index '
+                               'of synced bugs and comments')
     search_parser.set_defaults(func=bugz.cli.search)
 
+    sync_parser = subparsers.add_parser('sync',
+                                        argument_default=argparse.SUPPRESS,
+                                        help='add the bugs matching a '
+                                        'search to the local index')
+    add_search_arguments(sync_parser)
+    sync_parser.set_defaults(func=bugz.cli.sync)
+
+    tree_parser = subparsers.add_parser('tree',
+                                        argument_default=argparse.SUPPRESS,
+                                        help='show the dependency tree '
+                                        'of a bug')
+    tree_parser.add_argument('bugid',
+                             help='the ID of the bug at the root of the tree')
+    tree_parser.add_argument('--depth',
+                             type=int,
+                             help='maximum depth of the tree '
+                             '(default: unlimited)')
+    tree_parser.add_argument('--direction',
+                             choices=['depends', 'blocks'],
+                             default='depends',
+                             help='follow the bugs this bug depends on '
+                             'or the bugs it blocks (default: depends)')
+    tree_parser.add_argument('--dot',
+                             action='store_true',
+                             help='print the tree in graphviz dot format')
+    tree_parser.set_defaults(func=bugz.cli.tree)
+
+    watch_parser = subparsers.add_parser('watch',
+                                         argument_default=argparse.SUPPRESS,
+                                         help='poll a search and report '
+                                         'the bugs that change')
+    add_search_arguments(watch_parser)
+    watch_parser.add_argument('--interval',
+                              type=int,
+                              default=60,
+                              help='seconds between polls (default: 60)')
+    watch_parser.add_argument('--max-interval',
+                              type=int,
+                              default=600,
+                              help='longest time between polls while '
+                              'nothing changes (default: 600)')
+    watch_parser.add_argument('--format',
+                              choices=['text', 'jsonl'],
+                              default='text',
+                              help='output format; jsonl prints each '
+                              'changed bug as one line (default: text)')
+    watch_parser.add_argument('--exec',
+                              dest='exec_command',
+                              help='run this command for each changed bug, '
+                              'with the bug as json on its standard input '
+                              'and its id in BUGZ_BUG_ID; with jsonl its '
+                              'output goes to standard error')
+    watch_parser.set_defaults(func=bugz.cli.watch)
+
     return parser
@@ -0,0 +1,155 @@
+"""Shell completion helper.
+
+The completion scripts run "bugz __complete WORD..." with the words of
+the command line after "bugz", the last one being the word to complete.
+The candidates are printed one per line, optionally followed by a tab
+and a description.  Everything is answered from the configuration files
+and the local cache: this module must not import xmlrpc or ssl or touch
+the network, so that completion stays fast.
+"""
+
+import configparser
+import contextlib
+import os
+import sys
+import urllib.parse
+
+from bugz.cache import cache_dir, load_json, safe_name, save_json
+from bugz.configfile import load_config
+from bugz.metadata import metadata_path
+
+# the number of recently viewed bugs remembered per connection
+RECENT_BUGS = 100
+
+# options whose values can be completed, and where the values come from
+OPTION_VALUES = {
+    '--connection': 'connection',
+    '--connections': 'connection',
+    '--product': 'product',
+    '--component': 'component',
+    '-C': 'component',
+    '--set-keywords': 'keywords',
+    '--op-sys': 'op_sys',
+    '--platform': 'platform',
+    '--priority': 'priority',
+    '--severity': 'severity',
+    '-S': 'severity',
+}
+
+# sub-commands taking bug ids as their positional arguments
+BUG_COMMANDS = ['get', 'history', 'modify', 'tree', 'attach', 'grep']
+
+
+def recent_path(connection):
+    return os.path.join(cache_dir('recent'),
+                        '%s.json' % safe_name(connection))
+
+
+def remember_bugs(settings, buglist):
+    """Record bugs the user has looked at, for completing bug ids."""
+    path = recent_path(settings.connection)
+    recent = load_json(path, [])
+    ids = [bug['id'] for bug in buglist]
+    recent = [[bug['id'], bug.get('summary', '')] for bug in buglist] + \
+        [x for x in recent if x[0] not in ids]
+    save_json(path, recent[:RECENT_BUGS])
+
+
+def safe_base(base):
+    """Return base without the user name and password it may contain."""
+    parse_result = urllib.parse.urlparse(base)
+    netloc = parse_result.netloc.split('@')[-1]
+    return parse_result._replace(netloc=netloc).geturl()
+
+
+def option_value(words, option):
+    for i, word in enumerate(words[:-1]):
+        if word == option:
+            return words[i + 1]
+        if word.startswith(option + '='):
+            return word[len(option) + 1:]
+    return None
+
+
+def candidates(words):
+    """Return (value, description) pairs for the last of words."""
+    current = words[-1] if words else ''
+    previous = words[-2] if len(words) > 1 else ''
+    if current == '=':
+        # bash splits --option=value into three words
+        current = ''
+    elif previous == '=' and len(words) > 2:
+        previous = words[-3]
+    elif current.startswith('-') and '=' in current:
+        previous, current = current.split('=', 1)
+
+    # errors in the configuration are reported when bugz runs; printed
+    # here they would be taken for candidates
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            config = load_config(option_value(words, '--config-file'))
+        connection = option_value(words, '--connection')
+        if connection is None and config.has_option('default', 'connection'):
+            connection = config.get('default', 'connection')
+        bases = [(x, safe_base(config.get(x, 'base', fallback='')))
+                 for x in config.sections()]
+    except (SystemExit, configparser.Error):
+        return []
+
+    source = OPTION_VALUES.get(previous)
+    if source == 'connection':
+        values = bases
+    elif source is not None:
+        if connection is None:
+            return []
+        metadata = load_json(metadata_path(connection))
+        if metadata is None:
+            return []
+        product = option_value(words, '--product')
+        if source == 'product':
+            names = metadata['products']
+        elif source == 'component':
+            names = set()
+            for name, product_data in metadata['products'].items():
+                if product in [None, name]:
+                    names.update(product_data['components'])
+        else:
+            names = metadata['fields'].get(source, [])
+        values = [(x, '') for x in sorted(names)]
+    elif current.startswith('-'):
+        return []
+    else:
+        command = None
+        for word in words[:-1]:
+            if word in BUG_COMMANDS:
+                command = word
+                break
+        if command is None or connection is None:
+            return []
+        recent = load_json(recent_path(connection), [])
+        values = [('%s' % bugid, summary) for bugid, summary in recent]
+
+    return [x for x in values if x[0].startswith(current)]
+
+
+def complete(words):
+    for value, description in candidates(words):
+        if description:
+            print('%s\t%s' % (value, description))
+        else:
+            print(value)
+    return 0
+
+
+def main():
+    """Run bugz.
+
+    Completion requests are answered before bugz.cli, and with it xmlrpc
+    and ssl, are imported.
+    """
+    if sys.argv[1:2] == ['__complete']:
+        return complete(sys.argv[2:])
+
+    from bugz.cli import main as cli_main
+    return cli_main()
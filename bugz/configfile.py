@@ -52,3 +52,29 @@ def get_config_option(get, section, option):
         sys.exit(1)
 
     return value
+
+
+def queries_file():
+    return os.path.expanduser('~/.bugzqueries')
+
+
+def load_queries():
+    """Load the saved queries.
+
+    They are kept in ~/.bugzqueries, in the same format as the other
+    configuration files, so bugz can rewrite it without losing anything
+    the user wrote in ~/.bugzrc.  Each section is one query; its options
+    are Bug.search parameters encoded as json.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read(queries_file())
+    except configparser.Error as error:
+        log_error(error)
+        sys.exit(1)
+    return parser
+
+
+def save_queries(parser):
+    with open(queries_file(), 'w') as fd:
+        parser.write(fd)
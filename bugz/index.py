@@ -0,0 +1,78 @@
+"""Local full-text index of bugs.
+
+The summary, whiteboard and comment text of the bugs fetched by get and
+sync are stored in an SQLite FTS5 table, one database per connection,
+so search --local can answer without contacting the server.
+"""
+
+import os
+import sqlite3
+
+from bugz.cache import cache_dir, safe_name
+from bugz.exceptions import BugzError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bugs (
+    id INTEGER PRIMARY KEY,
+    status TEXT,
+    priority TEXT,
+    severity TEXT,
+    assigned_to TEXT,
+    summary TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS bug_text
+    USING fts5(summary, whiteboard, comments);
+"""
+
+
+def open_index(settings):
+    path = os.path.join(cache_dir('index'),
+                        '%s.sqlite' % safe_name(settings.connection))
+    db = sqlite3.connect(path)
+    try:
+        db.executescript(SCHEMA)
+    except sqlite3.Error as error:
+        db.close()
+        raise BugzError('Unable to open the local index: %s' % error)
+    return db
+
+
+def index_bugs(db, buglist, comments=None):
+    """Add or refresh bugs in the index.
+
+    comments maps bug ids to their comment lists.  The indexed comment
+    text of a bug is kept if its comments were not fetched this time.
+    """
+    if comments is None:
+        comments = {}
+    with db:
+        for bug in buglist:
+            bugid = bug['id']
+            db.execute('INSERT OR REPLACE INTO bugs VALUES (?, ?, ?, ?, ?, ?)',
+                       (bugid, bug.get('status', ''),
+                        bug.get('priority', ''), bug.get('severity', ''),
+                        bug.get('assigned_to', ''), bug.get('summary', '')))
+            if bugid in comments:
+                text = '\n'.join(c['text'] or '' for c in comments[bugid])
+            else:
+                row = db.execute('SELECT comments FROM bug_text '
+                                 'WHERE rowid = ?', (bugid,)).fetchone()
+                text = row[0] if row else ''
+            db.execute('DELETE FROM bug_text WHERE rowid = ?', (bugid,))
+            db.execute('INSERT INTO bug_text (rowid, summary, whiteboard, '
+                       'comments) VALUES (?, ?, ?, ?)',
+                       (bugid, bug.get('summary', ''),
+                        bug.get('whiteboard', ''), text))
+
+
+def search_index(db, query, limit=None):
+    """Return the indexed bugs matching query, best matches first."""
+    sql = ('SELECT bugs.id, status, priority, severity, assigned_to, '
+           'bugs.summary FROM bug_text JOIN bugs ON bugs.id = bug_text.rowid '
+           'WHERE bug_text MATCH ? ORDER BY bm25(bug_text) LIMIT ?')
+    keys = ['id', 'status', 'priority', 'severity', 'assigned_to', 'summary']
+    try:
+        rows = db.execute(sql, (query, limit or -1)).fetchall()
+    except sqlite3.Error as error:
+        raise BugzError('Local search failed: %s' % error)
+    return [dict(zip(keys, row)) for row in rows]
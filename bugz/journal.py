@@ -0,0 +1,88 @@
+"""Journals recording the progress of bulk operations.
+
+A journal is an append-only file of JSON lines.  The first line
+identifies the operation by a fingerprint of its parameters, and each
+following line records a completed step with the server's response.  A
+step is written and synced before the next one is started, so after an
+interruption the same operation can be resumed from the journal without
+repeating the completed steps.
+"""
+
+import hashlib
+import json
+import os
+
+from bugz.cache import json_default
+from bugz.exceptions import BugzError
+
+
+def fingerprint(command, data):
+    text = json.dumps([command, data], default=json_default, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class Journal:
+    def __init__(self, path, command, data, resume=False):
+        self.path = path
+        self.done = {}
+        digest = fingerprint(command, data)
+
+        if resume:
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except OSError as error:
+                raise BugzError('unable to read journal: %s' % error)
+            try:
+                header = json.loads(lines[0])
+            except (IndexError, ValueError):
+                raise BugzError('%s is not a journal' % path)
+            if header.get('fingerprint') != digest:
+                raise BugzError('%s is the journal of a different %s' %
+                                (path, header.get('command', 'command')))
+            for line in lines[1:]:
+                try:
+                    step = json.loads(line)
+                except ValueError:
+                    # the last line is incomplete if we were killed
+                    # while writing it
+                    continue
+                for key in step['keys']:
+                    self.done['%s' % key] = step['result']
+            self.fd = open(path, 'a')
+            if not lines[-1].endswith('\n'):
+                self.fd.write('\n')
+        else:
+            if os.path.exists(path) and os.path.getsize(path):
+                raise BugzError('%s already exists, use --resume to '
+                                'continue it' % path)
+            self.fd = open(path, 'w')
+            self.write({'command': command, 'fingerprint': digest})
+
+    def write(self, data):
+        self.fd.write(json.dumps(data, default=json_default) + '\n')
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def record(self, keys, result):
+        """Record that the steps named by keys are complete.
+
+        Keys are stored as strings, so they match the same way after
+        the journal is read back.
+        """
+        keys = ['%s' % key for key in keys]
+        self.write({'keys': keys, 'result': result})
+        for key in keys:
+            self.done[key] = result
+
+    def close(self):
+        self.fd.close()
+
+
+def open_journal(settings, command, data):
+    """Return the journal given by --journal or --resume, or None."""
+    if hasattr(settings, 'resume'):
+        return Journal(settings.resume, command, data, resume=True)
+    if hasattr(settings, 'journal'):
+        return Journal(settings.journal, command, data)
+    return None
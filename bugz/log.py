@@ -6,6 +6,8 @@
 
 debugLevel = 0
 quiet = False
+# None writes to sys.stdout
+output = None
 
 LogSettings = {
     'W': {
@@ -36,6 +38,11 @@ def log_setQuiet(newQuiet):
     quiet = newQuiet
 
 
+def log_setOutput(newOutput):
+    global output
+    output = newOutput
+
+
 def log_setDebugLevel(newLevel):
     global debugLevel
     if not newLevel:
@@ -53,7 +60,7 @@ def formatOut(msg, id='!'):
     word = LogSettings[id]['word'] + ":"
 
     for line in lines:
-        print(' {0} {1} {2}'.format(sym, word, line))
+        print(' {0} {1} {2}'.format(sym, word, line), file=output)
 
 
 def log_error(string):
@@ -0,0 +1,119 @@
+"""Legal values of the bug fields of a Bugzilla.
+
+The products, components, versions and the values of the other
+selectable fields are cached per connection.  A cache older than the
+metadata_ttl setting is still used, but is refreshed in the background.
+When the product is known, only that product is fetched into an empty
+cache, and other products are added when they are used.
+"""
+
+import os
+import threading
+import time
+
+from bugz.cache import cache_dir, load_json, safe_name, save_json
+from bugz.exceptions import BugzError
+from bugz.log import log_debug
+from bugz.metrics import CACHE_HITS, CACHE_MISSES
+
+# bugz names of the fields and their Bug.fields names
+FIELD_NAMES = {
+    'op_sys': 'op_sys',
+    'platform': 'rep_platform',
+    'priority': 'priority',
+    'severity': 'bug_severity',
+    'keywords': 'keywords',
+}
+
+
+def metadata_path(connection):
+    return os.path.join(cache_dir('metadata'),
+                        '%s.json' % safe_name(connection))
+
+
+def fetch_metadata(settings, bz, products=None):
+    """Fetch the legal field values from the server and cache them.
+
+    With a list of products, only their components and versions are
+    fetched, and the cache is marked as not listing all products.
+    """
+    params = {'names': list(FIELD_NAMES.values())}
+    result = settings.call_bz(bz.Bug.fields, params)
+    fields = {}
+    for field in result['fields']:
+        for key, name in FIELD_NAMES.items():
+            if field['name'] == name:
+                fields[key] = [x['name'] for x in field['values']
+                               if x.get('name')]
+
+    params = {'include_fields': ['name', 'components.name', 'versions.name']}
+    if products is None:
+        params['ids'] = settings.call_bz(bz.Product.get_accessible_products,
+                                         {})['ids']
+    else:
+        params['names'] = products
+    result = settings.call_bz(bz.Product.get, params)
+    product_data = {}
+    for product in result['products']:
+        product_data[product['name']] = {
+            'components': [x['name'] for x in product['components']],
+            'versions': [x['name'] for x in product['versions']],
+        }
+
+    metadata = {'time': time.time(), 'fields': fields,
+                'products': product_data, 'complete': products is None}
+    save_json(metadata_path(settings.connection), metadata)
+    return metadata
+
+
+def refresh_metadata(settings, products):
+    try:
+        fetch_metadata(settings, settings.make_proxy(), products)
+    except BugzError as error:
+        log_debug('unable to refresh the field values: %s' % error)
+
+
+def load_metadata(settings):
+    """Return the cached legal field values, or None if not available."""
+    if not settings.metadata_ttl:
+        return None
+    product = getattr(settings, 'product', None)
+    metadata = load_json(metadata_path(settings.connection))
+    products = None
+    if metadata is not None and not metadata.get('complete', True):
+        products = list(metadata['products'])
+
+    if metadata is None or \
+            (products is not None and product not in products):
+        CACHE_MISSES.inc(cache='metadata')
+        if product is None:
+            # all products are offered when prompting for one
+            products = None
+        else:
+            products = (products or []) + [product]
+        try:
+            return fetch_metadata(settings, settings.bz, products)
+        except BugzError as error:
+            log_debug('unable to fetch the field values: %s' % error)
+            return None
+    CACHE_HITS.inc(cache='metadata')
+    if time.time() - metadata['time'] > settings.metadata_ttl:
+        # the refresh is abandoned if bugz is done first
+        threading.Thread(target=refresh_metadata, args=(settings, products),
+                         daemon=True).start()
+    return metadata
+
+
+def legal_values(metadata, field, product=None):
+    """Return the legal values of field, or None if they are unknown."""
+    if metadata is None:
+        return None
+    if field == 'product':
+        if not metadata.get('complete', True):
+            return None
+        return sorted(metadata['products'])
+    if field in ['component', 'version']:
+        if product not in metadata['products']:
+            return None
+        return metadata['products'][product][field + 's']
+    return metadata['fields'].get(field)
@@ -0,0 +1,165 @@
+"""Counters and histograms describing what bugz does.
+
+The metrics are collected in-process for the whole run, from all
+threads, and can be read with snapshot() or rendered in the Prometheus
+text format or OpenMetrics by render().  export_metrics() writes them to
+a file when bugz exits and, optionally, every few seconds while it runs,
+for a node exporter textfile collector or similar to pick up.
+"""
+
+import atexit
+import os
+import tempfile
+import threading
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+_lock = threading.Lock()
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count which only goes up, e.g. of calls or bytes."""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with _lock:
+            return dict(self.values)
+
+    def samples(self):
+        for key, value in sorted(self.snapshot().items()):
+            yield self.name + '_total', key, None, value
+
+
+class Histogram:
+    """A distribution of observed values, e.g. of call durations."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            counts, total = self.values.get(key,
+                                            ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def snapshot(self):
+        """Return the cumulative bucket counts, sum and count of each set
+        of labels.
+        """
+        with _lock:
+            return dict((key, {'buckets': dict(zip(self.buckets, counts)),
+                               'sum': total, 'count': counts[-1]})
+                        for key, (counts, total) in self.values.items())
+
+    def samples(self):
+        for key, value in sorted(self.snapshot().items()):
+            for bound, count in value['buckets'].items():
+                le = ('le', _number(float(bound)))
+                yield self.name + '_bucket', key, le, count
+            yield self.name + '_sum', key, None, value['sum']
+            yield self.name + '_count', key, None, value['count']
+
+
+CALLS = Counter('bugz_calls', 'Calls made to Bugzilla, by method.')
+CALL_ERRORS = Counter('bugz_call_errors',
+                      'Calls to Bugzilla which failed, by method.')
+CALL_DURATION = Histogram('bugz_call_duration_seconds',
+                          'Time taken by calls to Bugzilla, by method.')
+REQUEST_BYTES = Counter('bugz_request_bytes',
+                        'Bytes of XML-RPC requests sent to Bugzilla.')
+RESPONSE_BYTES = Counter('bugz_response_bytes',
+                         'Bytes of XML-RPC responses read from Bugzilla.')
+RETRIES = Counter('bugz_retries',
+                  'Calls retried on a new connection or after logging in '
+                  'again, by reason.')
+CACHE_HITS = Counter('bugz_cache_hits',
+                     'Lookups answered by a local cache, by cache.')
+CACHE_MISSES = Counter('bugz_cache_misses',
+                       'Lookups a local cache could not answer, by cache.')
+
+
+def snapshot():
+    """Return the current values of all metrics, by name and labels."""
+    return dict((metric.name, metric.snapshot()) for metric in REGISTRY)
+
+
+def render(openmetrics=False):
+    """Return all metrics in the Prometheus text format, or OpenMetrics."""
+    lines = []
+    for metric in REGISTRY:
+        # OpenMetrics names counter families without the _total suffix
+        family = metric.name
+        if metric.kind == 'counter' and not openmetrics:
+            family += '_total'
+        lines.append('# HELP %s %s' % (family, metric.help))
+        lines.append('# TYPE %s %s' % (family, metric.kind))
+        for name, key, extra, value in metric.samples():
+            lines.append('%s%s %s' % (name, _labels(key, extra),
+                                      _number(value)))
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, openmetrics=False):
+    """Write all metrics to path, replacing it atomically."""
+    fd, name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(render(openmetrics))
+    os.chmod(name, 0o644)
+    os.replace(name, path)
+
+
+def export_metrics(path, interval=0, openmetrics=False):
+    """Write the metrics to path when bugz exits, and every interval
+    seconds until then if interval is set.
+    """
+    atexit.register(write_metrics, path, openmetrics)
+    if not interval:
+        return
+
+    def run():
+        while not stop.wait(interval):
+            write_metrics(path, openmetrics)
+
+    stop = threading.Event()
+    atexit.register(stop.set)
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,69 @@
+"""Compact representation of the bugs in large search results.
+
+list_bugs only needs six fields of each bug, but a decoded bug is a
+dictionary with its own copy of every key.  A BugRecord keeps just those
+fields in slots, with the often repeated strings interned, and
+CompactUnmarshaller builds them directly while a response is decoded,
+so no dictionary is ever made for a listed bug.
+
+Records are only for bugs which are listed.  bugz export writes every
+field of its bugs to the archive, so it keeps them as dictionaries, and
+holds only one batch of them at a time.
+"""
+
+import sys
+import xmlrpc.client
+
+LIST_FIELDS = ('id', 'status', 'priority', 'severity', 'assigned_to',
+               'summary')
+INTERNED_FIELDS = ('status', 'priority', 'severity', 'assigned_to')
+
+
+class BugRecord:
+    """A bug with only the fields shown by list_bugs.
+
+    It can be indexed like the dictionary of a bug.
+    """
+    __slots__ = LIST_FIELDS
+
+    def __init__(self, fields):
+        for key in LIST_FIELDS:
+            value = fields[key]
+            if key in INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return LIST_FIELDS
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in LIST_FIELDS)
+
+
+class CompactUnmarshaller(xmlrpc.client.Unmarshaller):
+    """Decode structures holding exactly LIST_FIELDS as BugRecords.
+
+    Searches meant for it should set include_fields to LIST_FIELDS.
+    """
+    dispatch = dict(xmlrpc.client.Unmarshaller.dispatch)
+
+    def end_struct(self, data):
+        mark = self._marks.pop()
+        items = self._stack[mark:]
+        fields = dict(zip(items[::2], items[1::2]))
+        if len(fields) == len(LIST_FIELDS) and \
+                all(key in fields for key in LIST_FIELDS):
+            self._stack[mark:] = [BugRecord(fields)]
+        else:
+            self._stack[mark:] = [fields]
+        self._value = 0
+    dispatch['struct'] = end_struct
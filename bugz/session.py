@@ -0,0 +1,75 @@
+"""Bugzilla login sessions kept between runs.
+
+Logging in with User.login returns a token, on Bugzilla 4.4.3 and
+later, which can be sent instead of the user name and password.  It is saved for each connection, readable
+only by its owner, so that later runs can use it without running the
+password command or asking for a password again.
+"""
+
+import os
+import time
+
+from bugz.cache import cache_dir, load_json, safe_name, save_json
+from bugz.log import log_debug
+
+# Faults returned by Bugzilla when a token is not (or no longer) valid.
+# Older versions report it as an unknown error (32000).
+INVALID_TOKEN_FAULTS = (307, 410)
+
+
+def session_path(settings):
+    return os.path.join(cache_dir('sessions'),
+                        safe_name(settings.connection) + '.json')
+
+
+def load_session(settings):
+    """Return the saved token for this connection and user, or None if
+    there is none or it is older than session_ttl seconds.
+    """
+    session = load_json(session_path(settings))
+    if session is None:
+        return None
+    if session.get('base') != settings.base or \
+            session.get('user') != getattr(settings, 'user', None):
+        return None
+    if time.time() - session.get('time', 0) > settings.session_ttl:
+        return None
+    return session.get('token')
+
+
+def session_expired(fault):
+    """Tell whether a fault means the token sent with a call is invalid."""
+    if fault.faultCode in INVALID_TOKEN_FAULTS:
+        return True
+    return fault.faultCode == 32000 and 'token' in fault.faultString
+
+
+def clear_session(settings):
+    try:
+        os.unlink(session_path(settings))
+    except OSError:
+        pass
+
+
+def login(settings):
+    """Log in with the user name and password and save the token.
+
+    Returns None if the server does not hand out tokens, as Bugzilla
+    before 4.4.3 does not; the user name and password are then sent
+    with each call.
+    """
+    log_debug('Logging in as {0}'.format(settings.user), 1)
+    result = settings.call_bz(settings.bz.User.login,
+                              {'login': settings.user,
+                               'password': settings.password})
+    if 'token' not in result:
+        log_debug('No session token returned, sending the password '
+                  'with each call', 1)
+        return None
+    save_json(session_path(settings), {
+        'base': settings.base,
+        'user': settings.user,
+        'token': result['token'],
+        'time': time.time(),
+    })
+    return result['token']
@@ -1,5 +1,7 @@
+import argparse
 import ssl
 import sys
+import time
 import urllib.error
 import urllib.parse
 import xml.parsers.expat
@@ -9,6 +11,9 @@ from bugz.configfile import get_config_option
 from bugz.exceptions import BugzError
 from bugz.log import log_debug, log_error, log_info
 from bugz.log import log_setDebugLevel, log_setQuiet
+from bugz.metrics import CALL_DURATION, CALL_ERRORS, CALLS, RETRIES
+from bugz.session import clear_session, login, session_expired
+from bugz.transport import make_transport
 from bugz.utils import terminal_width
 
 
@@ -123,13 +128,108 @@ class Settings:
             else:
                 self.insecure = False
 
+        if not hasattr(self, 'local_index'):
+            if config.has_option(self.connection, 'local_index'):
+                self.local_index = get_config_option(config.getboolean,
+                                                     self.connection,
+                                                     'local_index')
+            else:
+                self.local_index = False
+
+        if not hasattr(self, 'metadata_ttl'):
+            if config.has_option(self.connection, 'metadata_ttl'):
+                self.metadata_ttl = get_config_option(config.getint,
+                                                      self.connection,
+                                                      'metadata_ttl')
+            else:
+                self.metadata_ttl = 86400
+
+        if not hasattr(self, 'search_cache_ttl'):
+            if config.has_option(self.connection, 'search_cache_ttl'):
+                self.search_cache_ttl = get_config_option(config.getint,
+                                                          self.connection,
+                                                          'search_cache_ttl')
+            else:
+                self.search_cache_ttl = 0
+
+        if not hasattr(self, 'search_cache_size'):
+            if config.has_option(self.connection, 'search_cache_size'):
+                self.search_cache_size = get_config_option(config.getint,
+                                                           self.connection,
+                                                           'search_cache_size')
+            else:
+                self.search_cache_size = 100
+
+        if not hasattr(self, 'attachment_cache_size'):
+            if config.has_option(self.connection, 'attachment_cache_size'):
+                self.attachment_cache_size = get_config_option(
+                    config.getint, self.connection, 'attachment_cache_size')
+            else:
+                self.attachment_cache_size = 100
+
+        if not hasattr(self, 'max_response_size'):
+            if config.has_option(self.connection, 'max_response_size'):
+                self.max_response_size = get_config_option(
+                    config.getint, self.connection, 'max_response_size')
+            else:
+                self.max_response_size = 0
+
+        if not hasattr(self, 'max_search_results'):
+            if config.has_option(self.connection, 'max_search_results'):
+                self.max_search_results = get_config_option(
+                    config.getint, self.connection, 'max_search_results')
+            else:
+                self.max_search_results = 0
+
+        if not hasattr(self, 'max_attachment_size'):
+            if config.has_option(self.connection, 'max_attachment_size'):
+                self.max_attachment_size = get_config_option(
+                    config.getint, self.connection, 'max_attachment_size')
+            else:
+                self.max_attachment_size = 0
+
+        if not hasattr(self, 'metrics_file'):
+            if config.has_option(self.connection, 'metrics_file'):
+                self.metrics_file = get_config_option(config.get,
+                                                      self.connection,
+                                                      'metrics_file')
+
+        if not hasattr(self, 'metrics_interval'):
+            if config.has_option(self.connection, 'metrics_interval'):
+                self.metrics_interval = get_config_option(
+                    config.getint, self.connection, 'metrics_interval')
+            else:
+                self.metrics_interval = 0
+
+        if not hasattr(self, 'metrics_format'):
+            if config.has_option(self.connection, 'metrics_format'):
+                self.metrics_format = get_config_option(config.get,
+                                                        self.connection,
+                                                        'metrics_format')
+            else:
+                self.metrics_format = 'prometheus'
+            if self.metrics_format not in ['prometheus', 'openmetrics']:
+                log_error('metrics_format must be prometheus or openmetrics')
+                sys.exit(1)
+
+        if not hasattr(self, 'session_ttl'):
+            if config.has_option(self.connection, 'session_ttl'):
+                self.session_ttl = get_config_option(config.getint,
+                                                     self.connection,
+                                                     'session_ttl')
+            else:
+                self.session_ttl = 86400
+
         if getattr(self, 'encoding', None) is not None:
             log_info('The encoding option is deprecated.')
 
-        context=ssl._create_unverified_context() if self.insecure else None
+        self.context = ssl._create_unverified_context() if self.insecure \
+            else None
 
-        self.bz = xmlrpc.client.ServerProxy(self.base, context=context)
+        self.bz = self.make_proxy()
         self.connections = config.sections()
+        self.args = args
+        self.config = config
 
         parse_result = urllib.parse.urlparse(self.base)
         new_netloc = parse_result.netloc.split('@')[-1]
@@ -144,19 +244,59 @@ class Settings:
         for key in vars(self):
             log_debug('{0}, {1}'.format(key, getattr(self, key)), 3)
 
-    def call_bz(self, method, params):
-        """Attempt to call method with args.
+    def for_connection(self, connection):
+        """Return the settings for another connection, using the same
+        command line arguments.
+        """
+        args = argparse.Namespace(**vars(self.args))
+        args.connection = connection
+        return Settings(args, self.config)
+
+    def make_proxy(self, unmarshaller=xmlrpc.client.Unmarshaller):
+        """Return a new server proxy, decoding responses with unmarshaller.
+
+        A proxy keeps its connection open between calls, so it must not
+        be shared between threads; each worker thread needs its own.
+        """
+        transport = make_transport(self.base, self.context, unmarshaller,
+                                   self.max_response_size)
+        return xmlrpc.client.ServerProxy(self.base, transport=transport)
+
+    def add_auth(self, params):
+        """Add the credentials to the parameters of a call.
         """
         if hasattr(self, 'key'):
             params['Bugzilla_api_key'] = self.key
+        elif hasattr(self, 'token'):
+            params['Bugzilla_token'] = self.token
         else:
             if hasattr(self, 'user'):
                 params['Bugzilla_login'] = self.user
             if hasattr(self, 'password'):
                 params['Bugzilla_password'] = self.password
+
+    def call_bz(self, method, params):
+        """Attempt to call method with args.
+
+        If the saved session has expired, log in again and retry.
+        """
+        self.add_auth(params)
         try:
-            return method(params)
+            return self.timed_call(method, params)
         except xmlrpc.client.Fault as fault:
+            if 'Bugzilla_token' in params and session_expired(fault):
+                log_debug('Session expired: {0}'.format(fault.faultString), 1)
+                clear_session(self)
+                del self.token
+                del params['Bugzilla_token']
+                if not hasattr(self, 'password'):
+                    raise BugzError('Your Bugzilla session has expired, '
+                                    'please run the command again')
+                token = login(self)
+                if token is not None:
+                    self.token = token
+                RETRIES.inc(reason='session')
+                return self.call_bz(method, params)
             raise BugzError('Bugzilla error: {0}'.format(fault.faultString))
         except xmlrpc.client.ProtocolError as error:
             raise BugzError(error)
@@ -164,3 +304,17 @@ class Settings:
             raise BugzError(error)
         except xml.parsers.expat.ExpatError as error:
             raise BugzError(error)
+
+    def timed_call(self, method, params):
+        """Call method, counting the call and its time in the metrics."""
+        # the name of the method, e.g. Bug.get, is private to xmlrpc
+        name = getattr(method, '_Method__name', 'unknown')
+        CALLS.inc(method=name)
+        start = time.monotonic()
+        try:
+            return method(params)
+        except BaseException:
+            CALL_ERRORS.inc(method=name)
+            raise
+        finally:
+            CALL_DURATION.observe(time.monotonic() - start, method=name)
@@ -0,0 +1,134 @@
+"""xmlrpc transports used to talk to Bugzilla.
+
+They behave like the standard ones, except that the class used to
+decode the responses can be chosen per proxy, that responses larger
+than max_response_size bytes are refused while they are read, unless
+their data is spooled to disk, and that the bytes sent and read are
+counted in the metrics.
+"""
+
+import base64
+import re
+import tempfile
+import xmlrpc.client
+
+from bugz.exceptions import BugzError
+from bugz.metrics import REQUEST_BYTES, RESPONSE_BYTES
+
+
+def response_too_large(max_size):
+    return BugzError('The response from Bugzilla is larger than '
+                     'max_response_size ({0} bytes). Narrow the search or '
+                     'page through it with --limit and --offset, or save '
+                     'attachments to a file.'.format(max_size))
+
+
+class TransportMixin:
+    unmarshaller = xmlrpc.client.Unmarshaller
+    max_response_size = 0
+
+    def getparser(self):
+        target = self.unmarshaller(use_datetime=self._use_datetime,
+                                   use_builtin_types=self._use_builtin_types)
+        return xmlrpc.client.ExpatParser(target), target
+
+    def send_content(self, connection, request_body):
+        REQUEST_BYTES.inc(len(request_body))
+        super().send_content(connection, request_body)
+
+    def parse_response(self, response):
+        length = response.getheader('Content-Length')
+        if self.max_response_size and length is not None and \
+                int(length) > self.max_response_size:
+            self.close()
+            raise response_too_large(self.max_response_size)
+
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            stream = xmlrpc.client.GzipDecodedResponse(response)
+        else:
+            stream = response
+        parser, target = self.getparser()
+        size = 0
+        while True:
+            data = stream.read(1024)
+            if not data:
+                break
+            size += len(data)
+            RESPONSE_BYTES.inc(len(data))
+            if self.max_response_size and size > self.max_response_size:
+                self.close()
+                raise response_too_large(self.max_response_size)
+            parser.feed(data)
+        if stream is not response:
+            stream.close()
+        parser.close()
+        return target.close()
+
+
+class Transport(TransportMixin, xmlrpc.client.Transport):
+    pass
+
+
+class SafeTransport(TransportMixin, xmlrpc.client.SafeTransport):
+    pass
+
+
+class SpoolingUnmarshaller(xmlrpc.client.Unmarshaller):
+    """Decode base64 values into temporary files as they are read.
+
+    The value of a base64 element is a binary file positioned at its
+    start, so large attachments are never held in memory whole.
+    """
+    dispatch = dict(xmlrpc.client.Unmarshaller.dispatch)
+    # responses decoded by it need no max_response_size
+    spools = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._spool = None
+
+    def start(self, tag, attrs):
+        super().start(tag, attrs)
+        if tag.split(':')[-1] == 'base64':
+            self._spool = tempfile.TemporaryFile()
+            self._encoded = ''
+
+    def data(self, text):
+        if self._spool is None:
+            super().data(text)
+            return
+        self._encoded += re.sub(r'\s', '', text)
+        length = len(self._encoded) - len(self._encoded) % 4
+        if length >= 4096:
+            self._spool.write(base64.b64decode(self._encoded[:length]))
+            self._encoded = self._encoded[length:]
+
+    def end_base64(self, data):
+        self._spool.write(base64.b64decode(self._encoded))
+        self._spool.seek(0)
+        self.append(self._spool)
+        self._spool = None
+        self._value = 0
+    dispatch['base64'] = end_base64
+
+
+def make_transport(url, context=None,
+                   unmarshaller=xmlrpc.client.Unmarshaller,
+                   max_response_size=0):
+    if url.startswith('https:'):
+        transport = SafeTransport(context=context)
+    else:
+        transport = Transport()
+    transport.unmarshaller = unmarshaller
+    if not getattr(unmarshaller, 'spools', False):
+        transport.max_response_size = max_response_size
+    return transport
+
+
+def unmarshal(data, unmarshaller=xmlrpc.client.Unmarshaller):
+    """Decode a complete response, like xmlrpc.client.loads."""
+    target = unmarshaller()
+    parser = xmlrpc.client.ExpatParser(target)
+    parser.feed(data)
+    parser.close()
+    return target.close()
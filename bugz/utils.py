@@ -5,6 +5,11 @@ import sys
 import shutil
 import tempfile
 
+try:
+    import readline
+except ImportError:
+    readline = None
+
 BUGZ_COMMENT_TEMPLATE = """
 BUGZ: ---------------------------------------------------
 %s
@@ -51,6 +56,41 @@ def raw_input_block():
         except EOFError:
             return target
 
+
+def input_choice(prompt, choices=None):
+    """ Read a line, completing and checking it against choices.
+
+    An empty line is always accepted. Anything else is asked for again
+    until it is one of the choices.
+
+    @rtype: string
+    """
+    if readline is not None:
+        old_completer = readline.get_completer()
+        old_delims = readline.get_completer_delims()
+        matches = []
+
+        def complete(text, state):
+            if state == 0:
+                matches[:] = [x for x in choices or [] if x.startswith(text)]
+            return matches[state] if state < len(matches) else None
+
+        readline.set_completer(complete)
+        readline.set_completer_delims('')
+        readline.parse_and_bind('tab: complete')
+
+    try:
+        while True:
+            line = input(prompt)
+            if not line or not choices or line in choices:
+                return line
+            print('%s is not valid, choose one of: %s' %
+                  (line, ', '.join(choices)))
+    finally:
+        if readline is not None:
+            readline.set_completer(old_completer)
+            readline.set_completer_delims(old_delims)
+
 #
 # This function was lifted from Bazaar 1.9.
 #